@@ -11,16 +11,33 @@
 #
 # In this directory to get the dependencies in place and install the
 # provider layer this uses.
+#
+# By default all of the phases are run. To run only some of them, set
+# VTDS_TEST_PHASES to a comma separated list of the phases to run, for
+# example:
+#
+#    $ VTDS_TEST_PHASES=prepare,validate python3 ./simple_test.py
+#
+# The phases are always run in lifecycle order. Note that 'validate'
+# and 'deploy' need 'prepare' to have been run first.
 """Simplified driver for quick manual testing of the GCP provider
 layer.
 
 """
+from os import environ
 
 from vtds_base import (
     merge_configs,
     VTDSStack
 )
 
+# The phases of the lifecycle to run (see above).
+ALL_PHASES = "prepare,validate,deploy,dismantle,restore,remove"
+phases = {
+    phase.strip()
+    for phase in environ.get('VTDS_TEST_PHASES', ALL_PHASES).split(',')
+}
+
 # Create a vTDS stack with the provider and platform layers in it.
 stack = VTDSStack(
     "vtds_application_ubuntu",
@@ -40,25 +57,31 @@ provider_api = stack.get_provider_api()
 
 # Run the 'prepare' phase on the vTDS stack. Currently there is only a
 # provider, so this will only prepare the provider layer..
-print("Preparing the vTDS for deployment")
-stack.prepare()
+if 'prepare' in phases:
+    print("Preparing the vTDS for deployment")
+    stack.prepare()
 
 # Run the 'validate' phase on the vTDS stack. Again, only provider for now.
-print("Validating the vTDS...")
-stack.validate()
+if 'validate' in phases:
+    print("Validating the vTDS...")
+    stack.validate()
 
 # Run the 'deploy' phase on the vTDS stack. Again, only provider for now.
-print("Deploying the vTDS...")
-stack.deploy()
+if 'deploy' in phases:
+    print("Deploying the vTDS...")
+    stack.deploy()
 
 # For grins, tear down all the virtual blades in the provider layer...
-print("Dismantling provider project...")
-provider_api.dismantle()
+if 'dismantle' in phases:
+    print("Dismantling provider project...")
+    provider_api.dismantle()
 
 # ...and put them all back.
-print("Restoring provider project...")
-provider_api.restore()
+if 'restore' in phases:
+    print("Restoring provider project...")
+    provider_api.restore()
 
 # Run the remove phase on the vTDS stack. Again, only provider for now.
-print("Removing the vTDS...")
-stack.remove()
+if 'remove' in phases:
+    print("Removing the vTDS...")
+    stack.remove()
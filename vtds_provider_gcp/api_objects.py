@@ -36,6 +36,8 @@ class VirtualBlades(metaclass=ABCMeta):
     operations.
 
     """
+    __slots__ = ()
+
     @abstractmethod
     def blade_types(self):
         """Get a list of virtual blade types by name.
@@ -149,6 +151,8 @@ class BladeInterconnects(metaclass=ABCMeta):
     and public operations that can be performed on the interconnects.
 
     """
+    __slots__ = ()
+
     @abstractmethod
     def interconnect_names(self):
         """Get a list of blade interconnects by name
@@ -168,6 +172,8 @@ class BladeConnection(metaclass=ABCMeta):
     external connections to ports on a specific Virtual Blade.
 
     """
+    __slots__ = ()
+
     @abstractmethod
     def blade_type(self):
         """Return the name of the Virtual Blade type of the connected
@@ -211,6 +217,8 @@ class BladeConnectionSet(metaclass=ABCMeta):
     directly.
 
     """
+    __slots__ = ()
+
     @abstractmethod
     def list_connections(self, blade_type=None):
         """List the connections in the BladeConnectionSet filtered by
@@ -235,6 +243,8 @@ class BladeSSHConnection(BladeConnection, metaclass=ABCMeta):
     using SSH.
 
     """
+    __slots__ = ()
+
     @abstractmethod
     def copy_to(
         self, source, destination,
@@ -341,9 +351,12 @@ class BladeSSHConnectionSet(BladeConnectionSet, metaclass=ABCMeta):
     operations that run in parallel across multiple connections.
 
     """
+    __slots__ = ()
+
     @abstractmethod
     def copy_to(
-        self, source, destination, recurse=False, logname=None, blade_type=None
+        self, source, destination, recurse=False, logname=None,
+        blade_type=None, fail_fast=False
     ):
         """Copy the file at a path on the local machine ('source') to
         a path ('dest') on all of the selected blades (based on
@@ -353,6 +366,10 @@ class BladeSSHConnectionSet(BladeConnectionSet, metaclass=ABCMeta):
         errors they produce to raise a ContextualError exception
         describing the failures.
 
+        If 'fail_fast' is True, stop at the first failure instead:
+        terminate the copies still running on the other blades and
+        raise a ContextualError describing that failure.
+
         If the 'recurse' option is True and the local file is a
         directory, the directory and all of its descendants will be
         copied.
@@ -366,7 +383,7 @@ class BladeSSHConnectionSet(BladeConnectionSet, metaclass=ABCMeta):
         """
 
     @abstractmethod
-    def run_command(self, cmd, logname=None, blade_type=None):
+    def run_command(self, cmd, logname=None, blade_type=None, fail_fast=False):
         """Using SSH, run the command in the string 'cmd'
         asynchronously on all connected blades filtered by
         'blade_type'. If 'blade_type' is unspecified or None, run on
@@ -388,6 +405,10 @@ class BladeSSHConnectionSet(BladeConnectionSet, metaclass=ABCMeta):
         commands fail, collect the errors they produce to raise a
         ContextualError exception describing the failures.
 
+        If 'fail_fast' is True, stop at the first failure instead:
+        terminate the commands still running on the other blades and
+        raise a ContextualError describing that failure.
+
         If the 'logname' argument is provided, use the string found
         there to compose paths to two files, one that will contain the
         standard output from the command and one that will contain the
@@ -410,6 +431,8 @@ class Secrets:
     using the blade_ssh_key_secret() method.
 
     """
+    __slots__ = ()
+
     @abstractmethod
     def store(self, name, value):
         """Store a value (string) in the named secret.
@@ -422,3 +445,19 @@ class Secrets:
         value is present, return None.
 
         """
+
+    @abstractmethod
+    def store_batch(self, items):
+        """Store values (strings) in several secrets at once. The
+        'items' argument is a dictionary or an iterable of (name,
+        value) pairs.
+
+        """
+
+    @abstractmethod
+    def read_batch(self, names):
+        """Read the values (strings) stored in several named secrets
+        at once and return them as a dictionary indexed by secret
+        name. A secret with no value present maps to None.
+
+        """
@@ -28,5 +28,20 @@ from os.path import (
     join as path_join,
     dirname
 )
+
+# Parse and emit YAML with the libyaml (C) based safe loader and
+# dumper when PyYAML was built with them, since they are much faster
+# than the pure Python ones. They accept and produce the same YAML.
+try:
+    from yaml import (
+        CSafeLoader as YAMLLoader,
+        CSafeDumper as YAMLDumper
+    )
+except ImportError:
+    from yaml import (
+        SafeLoader as YAMLLoader,
+        SafeDumper as YAMLDumper
+    )
+
 CONFIG_DIR = path_join(dirname(__file__), "config")
 TERRAGRUNT_DIR = path_join(dirname(__file__), "terragrunt")
@@ -23,28 +23,51 @@
 """Private implementations of API objects.
 
 """
-from contextlib import contextmanager
+from contextlib import (
+    contextmanager,
+    ExitStack
+)
+from concurrent.futures import (
+    FIRST_EXCEPTION,
+    ThreadPoolExecutor,
+    wait as wait_futures
+)
+from functools import lru_cache
+from os import strerror
+from os.path import join as path_join
+from shlex import join as shell_join
+from shutil import (
+    rmtree,
+    which
+)
 from subprocess import (
     Popen,
     TimeoutExpired
 )
-from socketserver import TCPServer
 from socket import (
     socket,
     AF_INET,
-    SOCK_STREAM
+    SOCK_STREAM,
+    SOL_SOCKET,
+    SO_ERROR
 )
-from time import sleep
-from jinja2 import (
-    Template,
-    TemplateError
+from errno import (
+    ECONNREFUSED,
+    EINPROGRESS
+)
+from random import uniform
+from select import select
+from tempfile import mkdtemp
+from time import (
+    monotonic,
+    sleep
 )
 
 from vtds_base import (
     ContextualError,
-    log_paths,
     logfile,
-    info_msg
+    info_msg,
+    run
 )
 from ..api_objects import (
     VirtualBlades,
@@ -56,6 +79,24 @@ from ..api_objects import (
     Secrets
 )
 
+# Character sequences that mean a command string needs to go through
+# Jinja to be rendered. Besides the Jinja delimiters, this includes
+# line endings because Jinja normalizes those (and drops a trailing
+# newline), so only single line commands with no Jinja syntax can be
+# used as they are.
+JINJA_MARKERS = ('{{', '{%', '{#', '\n', '\r')
+
+# How long (in seconds) to wait before each attempt to restart an IAP
+# tunnel whose 'gcloud' command exited before the tunnel was ready.
+# Each wait is randomly stretched or shrunk by up to 20% so that
+# tunnels being set up together don't all retry in lock step. One
+# more attempt is made than there are entries here.
+RECONNECT_BACKOFF = (0.25, 0.5, 1, 2, 4, 8, 16, 16, 16)
+
+# The most blade connections that connect_blades() and
+# ssh_connect_blades() will try to set up at the same time.
+MAX_CONNECT_THREADS = 32
+
 
 # pylint: disable=invalid-name
 class PrivateVirtualBlades(VirtualBlades):
@@ -66,22 +107,33 @@ class PrivateVirtualBlades(VirtualBlades):
     0 and less that the number of blade instances in the class.
 
     """
+    __slots__ = ('common', 'key_paths', 'type_names')
+
     def __init__(self, common):
         """Constructor
 
         """
         self.common = common
+        # SSH key paths by blade type, filled in once the key files
+        # have been verified (see blade_ssh_key_paths()).
+        self.key_paths = {}
+        # The blade type names, computed on first use (see
+        # blade_types()).
+        self.type_names = None
 
     def blade_types(self):
         """Get a list of virtual blade types that are not pure base
-        classes by name.
+        classes by name. The list is computed once and returned as a
+        tuple so that it can be shared safely between callers.
 
         """
-        virtual_blades = self.common.get('virtual_blades', {})
-        return [
-            name for name in virtual_blades
-            if not virtual_blades[name].get('pure_base_class', False)
-        ]
+        if self.type_names is None:
+            virtual_blades = self.common.get('virtual_blades', {})
+            self.type_names = tuple(
+                name for name in virtual_blades
+                if not virtual_blades[name].get('pure_base_class', False)
+            )
+        return self.type_names
 
     def blade_count(self, blade_type):
         """Get the number of Virtual Blade instances of the specified
@@ -127,11 +179,106 @@ class PrivateVirtualBlades(VirtualBlades):
         private_path)' The value of 'private_path' is suitable for use
         with the '-i' option of 'ssh'. Before returning this call will
         verify that both files can be opened for reading and will fail
-        with a ContextualError if either cannot.
+        with a ContextualError if either cannot. Once the files for a
+        given blade type have been verified, the result is remembered
+        and they are not checked again.
+
+        """
+        if blade_type not in self.key_paths:
+            secret_name = self.common.blade_ssh_key_secret(blade_type)
+            self.key_paths[blade_type] = self.common.ssh_key_paths(
+                secret_name
+            )
+        return self.key_paths[blade_type]
+
+    def __connection_targets(self, blade_types):
+        """class private: Compose a list of (blade_type, instance)
+        pairs covering every instance of each of the Virtual Blade
+        types named in 'blade_types'. If 'blade_types' is None, all
+        available blade types are used.
 
         """
-        secret_name = self.common.blade_ssh_key_secret(blade_type)
-        return self.common.ssh_key_paths(secret_name)
+        blade_types = (
+            self.blade_types() if blade_types is None else blade_types
+        )
+        return [
+            (blade_type, instance)
+            for blade_type in blade_types
+            for instance in range(0, self.blade_count(blade_type))
+        ]
+
+    @staticmethod
+    def __disconnect_all(connections):
+        """class private: Disconnect all of the connections in
+        'connections' concurrently, since taking down a tunnel can
+        involve waiting for it to exit. Every connection is
+        disconnected even if some of them fail. The first error seen
+        (if any) is raised once they are all done.
+
+        """
+        if not connections:
+            return
+        # Ask all of the tunnels to exit before waiting for any of
+        # them, so they all shut down at once even when there are
+        # more connections than worker threads.
+        for connection in connections:
+            # This is a layer private operation not really class
+            # private. Treat this reference as friendly.
+            connection._hangup()  # pylint: disable=protected-access
+        workers = min(MAX_CONNECT_THREADS, len(connections))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                # This is a layer private operation not really class
+                # private. Treat this reference as friendly.
+                #
+                # pylint: disable=protected-access
+                executor.submit(connection._disconnect)
+                for connection in connections
+            ]
+        errors = [
+            future.exception() for future in futures
+            if future.exception() is not None
+        ]
+        if errors:
+            raise errors[0]
+
+    @staticmethod
+    def __connect_all(make_connection, targets, exit_stack):
+        """class private: Call 'make_connection(blade_type, instance)'
+        for each of the (blade_type, instance) pairs in 'targets'
+        concurrently and return the resulting list of connections in
+        the same order as 'targets'. Setting up a connection is mostly
+        spent waiting for a tunnel to come up, so doing them in
+        parallel turns the sum of those waits into roughly the
+        longest of them. The connections that come up are registered
+        with 'exit_stack' to be disconnected (also concurrently) when
+        the stack unwinds. If any of the connections fail, raise the
+        first error seen, leaving the stack to clean up the ones that
+        succeeded.
+
+        """
+        connections = []
+        if not targets:
+            return connections
+        exit_stack.callback(
+            PrivateVirtualBlades.__disconnect_all, connections
+        )
+        workers = min(MAX_CONNECT_THREADS, len(targets))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(make_connection, *target)
+                for target in targets
+            ]
+        errors = []
+        for future in futures:
+            try:
+                connections.append(future.result())
+            # pylint: disable=broad-exception-caught
+            except Exception as err:
+                errors.append(err)
+        if errors:
+            raise errors[0]
+        return connections
 
     @contextmanager
     def connect_blade(self, blade_type, instance, remote_port):
@@ -165,23 +312,19 @@ class PrivateVirtualBlades(VirtualBlades):
         connections in the resulting list are closed.
 
         """
-        blade_types = (
-            self.blade_types() if blade_types is None else blade_types
-        )
-        connections = [
-            PrivateBladeConnection(
-                self.common, blade_type, instance, remote_port
+        # Every connection that gets set up is registered on the
+        # exit stack, so all of them are closed on the way out, even
+        # if setting up some of the others failed or closing one of
+        # them fails.
+        with ExitStack() as exit_stack:
+            connections = self.__connect_all(
+                lambda blade_type, instance: PrivateBladeConnection(
+                    self.common, blade_type, instance, remote_port
+                ),
+                self.__connection_targets(blade_types),
+                exit_stack
             )
-            for blade_type in blade_types
-            for instance in range(0, self.blade_count(blade_type))
-        ]
-        try:
             yield PrivateBladeConnectionSet(self.common, connections)
-        finally:
-            for connection in connections:
-                # This is a layer private operation not really class
-                # private. Treat this reference as friendly.
-                connection._disconnect()  # pylint: disable=protected-access
 
     @contextmanager
     def ssh_connect_blade(self, blade_type, instance, remote_port=22):
@@ -217,25 +360,27 @@ class PrivateVirtualBlades(VirtualBlades):
         connections create are closed.
 
         """
-        blade_types = (
-            self.blade_types() if blade_types is None else blade_types
-        )
-        connections = [
-            PrivateBladeSSHConnection(
-                self.common, blade_type, instance,
-                self.blade_ssh_key_paths(blade_type)[1],
-                remote_port
+        targets = self.__connection_targets(blade_types)
+        # Look up (and verify) the private key once per blade type
+        # here, rather than once per instance in the worker threads.
+        key_paths = {
+            blade_type: self.blade_ssh_key_paths(blade_type)[1]
+            for blade_type in {blade_type for blade_type, _ in targets}
+        }
+        # Every connection that gets set up is registered on the
+        # exit stack, so all of them are closed on the way out, even
+        # if setting up some of the others failed or closing one of
+        # them fails.
+        with ExitStack() as exit_stack:
+            connections = self.__connect_all(
+                lambda blade_type, instance: PrivateBladeSSHConnection(
+                    self.common, blade_type, instance,
+                    key_paths[blade_type], remote_port
+                ),
+                targets,
+                exit_stack
             )
-            for blade_type in blade_types
-            for instance in range(0, self.blade_count(blade_type))
-        ]
-        try:
             yield PrivateBladeSSHConnectionSet(self.common, connections)
-        finally:
-            for connection in connections:
-                # This is a layer private operation not really class
-                # private. Treat this reference as friendly.
-                connection._disconnect()  # pylint: disable=protected-access
 
 
 class PrivateBladeInterconnects(BladeInterconnects):
@@ -248,56 +393,59 @@ class PrivateBladeInterconnects(BladeInterconnects):
 
         """
         self.common = common
-
-    def __interconnects_by_name(self):
-        """Return a dictionary of non-pure-base-class interconnects
+        # Index the interconnects by network name up front. This
+        # validates the interconnect configuration once, so a bad
+        # configuration is reported here, and the lookups after this
+        # are plain dictionary operations.
+        self.by_name = self.__index_interconnects()
+
+    def __index_interconnects(self):
+        """Build a dictionary of non-pure-base-class interconnects
         indexed by 'network_name'
 
         """
         blade_interconnects = self.common.get("blade_interconnects", {})
-        try:
-            return {
-                interconnect['network_name']: interconnect
-                for _, interconnect in blade_interconnects.items()
-                if not interconnect.get('pure_base_class', False)
-            }
-        except KeyError as err:
-            # Since we are going to error out anyway, build a list of
-            # interconnects without network names so we can give a
-            # more useful error message.
-            missing_names = [
-                key for key, interconnect in blade_interconnects.items()
-                if 'network_name' not in interconnect
-            ]
+        by_name = {}
+        missing_names = []
+        for key, interconnect in blade_interconnects.items():
+            if interconnect.get('pure_base_class', False):
+                continue
+            if 'network_name' not in interconnect:
+                missing_names.append(key)
+                continue
+            by_name[interconnect['network_name']] = interconnect
+        if missing_names:
             raise ContextualError(
                 "provider config error: 'network_name' not specified in "
                 "the following blade interconnects: %s" % str(missing_names)
-            ) from err
+            )
+        return by_name
 
     def interconnect_names(self):
         """Get a list of blade interconnects by name
 
         """
-        return self.__interconnects_by_name().keys()
+        return self.by_name.keys()
 
     def ipv4_cidr(self, interconnect_name):
         """Return the (string) IPv4 CIDR (<IP>/<length>) for the
         network on the named interconnect.
 
         """
-        blade_interconnects = self.__interconnects_by_name()
-        if interconnect_name not in blade_interconnects:
+        try:
+            interconnect = self.by_name[interconnect_name]
+        except KeyError as err:
             raise ContextualError(
                 "requesting ipv4_cidr of unknown blade interconnect '%s'" %
                 interconnect_name
-            )
-        interconnect = blade_interconnects.get(interconnect_name, {})
-        if 'ipv4_cidr' not in interconnect:
+            ) from err
+        try:
+            return interconnect['ipv4_cidr']
+        except KeyError as err:
             raise ContextualError(
                 "provider layer configuration error: no 'ipv4_cidr' found in "
                 "blade interconnect named '%s'" % interconnect_name
-            )
-        return interconnect['ipv4_cidr']
+            ) from err
 
 
 class PrivateBladeConnection(BladeConnection):
@@ -305,6 +453,13 @@ class PrivateBladeConnection(BladeConnection):
     external connections to ports on a specific Virtual Blade.
 
     """
+    # One of these is created for every blade instance in a
+    # connect_blades() call, so keep them small.
+    __slots__ = (
+        'common', 'b_type', 'instance', 'rem_port', 'hostname', 'loc_ip',
+        'loc_port', 'subprocess', 'conn_logs', 'log_dir',
+    )
+
     def __init__(self, common, blade_type, instance, remote_port):
         """Constructor
 
@@ -319,6 +474,15 @@ class PrivateBladeConnection(BladeConnection):
         self.loc_ip = "127.0.0.1"
         self.loc_port = None
         self.subprocess = None
+        # The log directory is only created once for all
+        # connections, after that composing log paths (see
+        # _log_paths()) costs no system calls.
+        self.log_dir = self.common.log_dir()
+        logname = "connection-%s-port-%d" % (self.hostname, self.rem_port)
+        self.conn_logs = (
+            path_join(self.log_dir, "%s-out.txt" % logname),
+            path_join(self.log_dir, "%s-err.txt" % logname),
+        )
         self._connect()
 
     def _connect(self):
@@ -326,96 +490,30 @@ class PrivateBladeConnection(BladeConnection):
         the local IP and port of the connection.
 
         """
-        # pylint: disable=protected-access
-        zone = self.common.get_zone()
-
-        # pylint: disable=protected-access
-        project_id = self.common.get_project_id()
-
-        out_path, err_path = log_paths(
-            self.common.build_dir(),
-            "connection-%s-port-%d" % (self.hostname, self.rem_port)
-        )
-        reconnects = 10
-        while reconnects > 0:
-            # Get a "free" port to use for the connection by briefly
-            # binding a TCP server and then destroying it before it
-            # listens on anything.
-            with TCPServer((self.loc_ip, 0), None) as tmp:
-                self.loc_port = tmp.server_address[1]
-
-            with logfile(out_path) as out, logfile(err_path) as err:
-                # Not using 'with' for the Popen because the Popen
-                # object becomes part of this class instance for the
-                # duration of the class instance's life cycle. The
-                # instance itself is handed out through a context
-                # manager which will disconnect and destroy the Popen
-                # object when the context ends.
-                #
-                # pylint: disable=consider-using-with
-                cmd = [
-                    'gcloud', 'compute', '--project=%s' % project_id,
-                    'start-iap-tunnel',
-                    '--zone=%s' % zone,
-                    '--local-host-port=%s:%s' % (self.loc_ip, self.loc_port),
-                    self.hostname,
-                    str(self.rem_port)
-                ]
-                self.subprocess = Popen(
-                    cmd,
-                    stdout=out, stderr=err,
-                    text=True, encoding='UTF-8'
-                )
-
-            # Wait for the tunnel to be established before returning.
-            retries = 60
-            while retries > 0:
-                # If the connection command fails, then break out of
-                # the loop, since there is no point trying to connect
-                # to a port that will never be there.
-                exit_status = self.subprocess.poll()
-                if exit_status is not None:
-                    info_msg(
-                        "IAP connection to '%s' on port %d "
-                        "terminated with exit status %d [%s%s]" % (
-                            self.hostname, self.rem_port, exit_status,
-                            "retrying" if reconnects > 1 else "failing",
-                            " - details in '%s'" % err_path if reconnects <= 1
-                            else ""
-                        )
-                    )
-                    break
-                with socket(AF_INET, SOCK_STREAM) as tmp:
-                    try:
-                        tmp.connect((self.loc_ip, self.loc_port))
-                        return
-                    except ConnectionRefusedError:
-                        sleep(1)
-                        retries -= 1
-                    except Exception as err:
-                        self._disconnect()
-                        raise ContextualError(
-                            "internal error: failed attempt to connect to "
-                            "service on IAP tunnel to '%s' port %d "
-                            "(local port = %s, local IP = %s) "
-                            "connect cmd was %s - %s" % (
-                                self.hostname, self.rem_port,
-                                self.loc_port, self.loc_ip,
-                                str(cmd),
-                                str(err)
-                            ),
-                            out_path, err_path
-                        ) from err
-            # If we got out of the loop either the connection command
-            # terminated or we timed out trying to connect, keep
-            # trying the connection from scratch a few times.
-            reconnects -= 1
-            self._disconnect()
-            # If we timed out, we have waited long enough to reconnect
-            # immediately. If not, give it some time to get better
-            # then reconnect.
-            if retries > 0:
-                sleep(10)
+        out_path, err_path = self.conn_logs
+        reconnects = len(RECONNECT_BACKOFF) + 1
+        # Open the log files once for all of the attempts. Every
+        # attempt's tunnel command inherits the same open files, and
+        # so shares their file offsets, so each attempt's output
+        # follows the previous one's instead of overwriting it.
+        with logfile(out_path) as out, logfile(err_path) as err:
+            while reconnects > 0:
+                cmd = self.__start_tunnel(out, err)
+                if self.__wait_for_tunnel(cmd, reconnects <= 1):
+                    return
+                # Either the connection command terminated or we
+                # timed out trying to connect, keep trying the
+                # connection from scratch a few times.
+                reconnects -= 1
+                timed_out = self.subprocess.poll() is None
+                self._disconnect()
+                # If we timed out, we have waited long enough to
+                # reconnect immediately. If not, give it some time to
+                # get better then reconnect (unless this was the last
+                # try).
+                if not timed_out and reconnects > 0:
+                    backoff = RECONNECT_BACKOFF[-reconnects]
+                    sleep(uniform(0.8 * backoff, 1.2 * backoff))
         # The reconnect loop ended without a successful connection,
         # report the error and bail out...
         raise ContextualError(
@@ -424,17 +522,173 @@ class PrivateBladeConnection(BladeConnection):
             "- connect command was %s" % (
                 self.hostname, self.rem_port,
                 self.loc_port, self.loc_ip,
-                str(cmd)
+                shell_join(cmd)
             ),
             out_path, err_path
         )
 
+    def __start_tunnel(self, out, err):
+        """class private: Pick a local port and start the 'gcloud'
+        command that runs the IAP tunnel from that port to the remote
+        port on the blade, with its standard output and standard
+        error going to the open files 'out' and 'err', without
+        waiting for the tunnel to be ready. Return the command that
+        was started.
+
+        """
+        # Get a "free" port to use for the connection by briefly
+        # binding a socket to an ephemeral port and then closing
+        # it before it listens on anything.
+        with socket(AF_INET, SOCK_STREAM) as tmp:
+            tmp.bind((self.loc_ip, 0))
+            self.loc_port = tmp.getsockname()[1]
+        cmd = [
+            tool_path('gcloud'), 'compute',
+            '--project=%s' % self.common.get_project_id(),
+            'start-iap-tunnel',
+            '--zone=%s' % self.common.get_zone(),
+            '--local-host-port=%s:%s' % (self.loc_ip, self.loc_port),
+            self.hostname,
+            str(self.rem_port)
+        ]
+        # Not using 'with' for the Popen because the Popen object
+        # becomes part of this class instance for the duration of the
+        # class instance's life cycle. The instance itself is handed
+        # out through a context manager which will disconnect and
+        # destroy the Popen object when the context ends.
+        #
+        # No need to close fds in the child, nothing this process
+        # opens is inheritable (PEP 446). Along with the absolute path
+        # to 'gcloud' this lets subprocess use posix_spawn() instead
+        # of fork() and exec().
+        #
+        # pylint: disable=consider-using-with
+        self.subprocess = Popen(
+            cmd,
+            stdout=out, stderr=err,
+            close_fds=False,
+            env=self.common.gcloud_env()
+        )
+        return cmd
+
+    def __wait_for_tunnel(self, cmd, last_try):
+        """class private: Wait for the tunnel started by 'cmd' to
+        accept connections. Return True once it does, or False if the
+        tunnel command exits or the tunnel is not ready in time. The
+        'last_try' argument only affects how an early exit of the
+        tunnel command is reported.
+
+        """
+        out_path, err_path = self.conn_logs
+        # Probe often at first, since the tunnel is frequently ready
+        # quickly, then back off to avoid spinning. Give up once
+        # 'deadline' passes. The deadline is on the monotonic clock,
+        # so the time spent in the probes themselves counts and clock
+        # changes don't.
+        deadline = monotonic() + 60
+        delay = 0.01
+        while monotonic() < deadline:
+            # If the connection command fails, then stop waiting,
+            # since there is no point trying to connect to a port
+            # that will never be there.
+            exit_status = self.subprocess.poll()
+            if exit_status is not None:
+                info_msg(
+                    "IAP connection to '%s' on port %d "
+                    "terminated with exit status %d [%s%s]" % (
+                        self.hostname, self.rem_port, exit_status,
+                        "failing" if last_try else "retrying",
+                        " - details in '%s'" % err_path if last_try
+                        else ""
+                    )
+                )
+                return False
+            try:
+                if self.__probe_tunnel(delay):
+                    return True
+                delay = min(delay * 2, 0.25)
+            except Exception as err:
+                self._disconnect()
+                raise ContextualError(
+                    "internal error: failed attempt to connect to "
+                    "service on IAP tunnel to '%s' port %d "
+                    "(local port = %s, local IP = %s) "
+                    "connect cmd was %s - %s" % (
+                        self.hostname, self.rem_port,
+                        self.loc_port, self.loc_ip,
+                        shell_join(cmd),
+                        str(err)
+                    ),
+                    out_path, err_path
+                ) from err
+        return False
+
+    def _log_paths(self, logname):
+        """Layer private operation: compose the standard output and
+        standard error log paths for 'logname' on this blade, in the
+        same form vtds_base.log_paths() uses, without checking for the
+        log directory again.
+
+        """
+        logname = "%s-%s" % (logname, self.hostname)
+        return (
+            path_join(self.log_dir, "%s-out.txt" % logname),
+            path_join(self.log_dir, "%s-err.txt" % logname),
+        )
+
+    def __probe_tunnel(self, timeout):
+        """class private: Make one non-blocking attempt to connect to
+        the local end of the tunnel, taking at most 'timeout' seconds
+        to find out whether it worked. Return True if the tunnel
+        accepted the connection and False if it is not ready yet. Any
+        other failure is raised as an OSError.
+
+        """
+        with socket(AF_INET, SOCK_STREAM) as probe:
+            probe.setblocking(False)
+            status = probe.connect_ex((self.loc_ip, self.loc_port))
+            if status == EINPROGRESS:
+                _, writable, _ = select([], [probe], [], timeout)
+                if not writable:
+                    # Still connecting, call it not ready yet.
+                    return False
+                status = probe.getsockopt(SOL_SOCKET, SO_ERROR)
+            if status == 0:
+                return True
+            if status == ECONNREFUSED:
+                # Nothing listening yet, wait a bit before the next
+                # try.
+                sleep(timeout)
+                return False
+            raise OSError(status, strerror(status))
+
+    def _hangup(self):
+        """Layer private operation: ask the tunnel command to exit
+        without waiting for it to do so. The connection still needs
+        to be dropped with _disconnect(), which then finds the tunnel
+        already on its way out.
+
+        """
+        if self.subprocess is not None:
+            self.subprocess.terminate()
+
     def _disconnect(self):
-        """Layer private operation: drop the connection.
+        """Layer private operation: drop the connection. The tunnel
+        command is given a moment to exit cleanly before it is
+        killed, and is always reaped so it does not linger as a
+        zombie.
+
         """
-        self.subprocess.kill()
-        self.subprocess = None
+        subprocess, self.subprocess = self.subprocess, None
         self.loc_port = None
+        if subprocess is None:
+            return
+        subprocess.terminate()
+        try:
+            subprocess.wait(timeout=2)
+        except TimeoutExpired:
+            subprocess.kill()
+            subprocess.wait()
 
     def blade_type(self):
         """Return the name of the Virtual Blade type of the connected
@@ -484,19 +738,34 @@ class PrivateBladeConnectionSet(BladeConnectionSet):
 
         """
         self.common = common
-        self.blade_connections = blade_connections
+        # The connections and the per-type groupings of them are kept
+        # as tuples so list_connections() can hand them out directly
+        # without copying them.
+        self.blade_connections = tuple(blade_connections)
+        self.connections_by_host = {
+            blade_connection.blade_hostname(): blade_connection
+            for blade_connection in blade_connections
+        }
+        by_type = {}
+        for blade_connection in blade_connections:
+            by_type.setdefault(
+                blade_connection.blade_type(), []
+            ).append(blade_connection)
+        self.connections_by_type = {
+            blade_type: tuple(connections)
+            for blade_type, connections in by_type.items()
+        }
 
     def list_connections(self, blade_type=None):
         """List the connections in the BladeConnectionSet filtered by
         'blade_type' if that is present. Otherwise imply list all of
-        the connections.
+        the connections. The result is a tuple shared with the
+        BladeConnectionSet, not a copy.
 
         """
-        return [
-            blade_connection for blade_connection in self.blade_connections
-            if blade_type is None or
-            blade_connection.blade_type() == blade_type
-        ]
+        if blade_type is None:
+            return self.blade_connections
+        return self.connections_by_type.get(blade_type, ())
 
     def get_connection(self, hostname):
         """Return the connection corresponding to the specified
@@ -504,61 +773,138 @@ class PrivateBladeConnectionSet(BladeConnectionSet):
         not found.
 
         """
-        for blade_connection in self.blade_connections:
-            if blade_connection.blade_hostname == hostname:
-                return blade_connection
-        return None
+        return self.connections_by_host.get(hostname, None)
 
 
 # The following is shared by PrivateBladeSSHConnection and
 # PrivateBladeSSHConnectionSet. This should be treaded as private to
 # this file. It is pulled out of both classes for easy sharing.
-def wait_for_popen(subprocess, cmd, logpaths, timeout=None, **kwargs):
+@lru_cache(maxsize=None)
+def tool_path(name):
+    """Return the absolute path of the command 'name' found on the
+    PATH, or just 'name' if it cannot be found there (letting the
+    eventual Popen() report the problem). Looked up paths are cached.
+    Using an absolute path lets subprocess start the command with
+    posix_spawn() (it only does that for paths with a directory in
+    them) and saves a PATH search every time the command is run.
+
+    """
+    return which(name) or name
+
+
+@lru_cache(maxsize=1)
+def jinja_environment():
+    """Return the Jinja Environment used to compile blade commands,
+    creating it the first time it is needed. Blade commands are shell
+    command lines, not HTML, so no autoescaping is done.
+
+    """
+    # pylint: disable=import-outside-toplevel
+    from jinja2 import Environment
+    return Environment(autoescape=False)
+
+
+@lru_cache(maxsize=512)
+def compile_cmd(cmd):
+    """Compile the specified command string into a Jinja Template and
+    return the Template. The same command is typically run on every
+    blade in a connection set, and often more than once, so compiled
+    templates are cached by command string and only parsed once.
+
+    """
+    return jinja_environment().from_string(cmd)
+
+
+def prepare_cmd(cmd):
+    """Return the compiled Jinja Template for the blade command
+    'cmd', or None if 'cmd' contains no Jinja syntax and can be used
+    as it is. Raise a ContextualError if 'cmd' is not a valid
+    template.
+
+    """
+    if not any(marker in cmd for marker in JINJA_MARKERS):
+        return None
+    # Jinja is only needed once a templated command is actually run
+    # on a blade, so don't make everyone who imports the provider
+    # layer pay for loading it.
+    #
+    # pylint: disable=import-outside-toplevel
+    from jinja2 import TemplateError
+    try:
+        return compile_cmd(cmd)
+    except TemplateError as err:
+        raise ContextualError(
+            "error using Jinja to compile command line '%s' - %s" % (
+                cmd,
+                str(err)
+            )
+        ) from err
+
+
+def describe_cmd(cmd):
+    """Return a string describing 'cmd' for use in messages. If 'cmd'
+    is a Popen() style list of arguments, it is quoted and joined the
+    way a shell would need it so it can be copied and pasted. If it is
+    already a string, it is returned as it is.
+
+    """
+    return cmd if isinstance(cmd, str) else shell_join(cmd)
+
+
+def stop_popens(subprocesses, grace=5):
+    """Stop the Popen() objects in 'subprocesses' and reap them:
+    first try to terminate all of them, then kill any that have not
+    gone away within 'grace' seconds. Processes that have already
+    exited are left alone.
+
+    """
+    for subprocess in subprocesses:
+        subprocess.terminate()
+    deadline = monotonic() + grace
+    for subprocess in subprocesses:
+        try:
+            subprocess.wait(timeout=max(0, deadline - monotonic()))
+        except TimeoutExpired:
+            subprocess.kill()
+            subprocess.wait()
+
+
+def wait_for_popen(subprocess, cmd, logpaths, timeout=None, check=True):
     """Wait for a Popen() object to reach completion and return
     the exit value.
 
-    If 'check' is either omitted from the keyword arguments or is
-    supplied in the keyword aguments and True, raise a
-    ContextualError if the command exists with a non-zero exit
-    value, otherwise simply return the exit value.
+    If 'check' is True (the default), raise a ContextualError if the
+    command exits with a non-zero exit value, otherwise simply return
+    the exit value.
+
+    If 'timeout' is supplied (in seconds) and exceeded, terminate
+    the Popen() object (killing it if it does not exit promptly) and
+    then raise a ContextualError indicating the timeout and reporting
+    where the command logs can be found.
 
-    If 'timeout' is supplied (in seconds) and exceeded kill the
-    Popen() object and then raise a ContextualError indicating the
-    timeout and reporting where the command logs can be found.
+    The 'cmd' argument is only used in error messages. It can be
+    either the Popen() command list or a descriptive string.
 
     """
-    info_msg(
-        "waiting for popen: "
-        "subproc='%s', cmd='%s', logpaths='%s', timeout='%s', kwargs='%s'" % (
-            str(subprocess), str(cmd), str(logpaths), str(timeout), str(kwargs)
-        )
-    )
-    check = kwargs.get('check', True)
-    time = timeout if timeout is not None else 0
-    signaled = False
-    while True:
+    if timeout is None:
+        # Nothing to watch for, just block until the process exits.
+        exitval = subprocess.wait()
+    else:
         try:
-            exitval = subprocess.wait(timeout=5)
-            break
-        except TimeoutExpired:
-            time -= 5 if timeout is not None else 0
-            if timeout is not None and time <= 0:
-                if not signaled:
-                    # First try to terminate the process
-                    subprocess.terminate()
-                    continue
-                subprocess.kill()
-                # pylint: disable=raise-missing-from
-                raise ContextualError(
-                    "SSH command '%s' timed out and did not terminate "
-                    "as expected after %d seconds" % (str(cmd), time),
-                    *logpaths
-                )
-            continue
+            exitval = subprocess.wait(timeout=timeout)
+        except TimeoutExpired as err:
+            # First try to terminate the process, then kill it if it
+            # doesn't go away.
+            stop_popens([subprocess])
+            raise ContextualError(
+                "SSH command '%s' timed out after %s seconds and was "
+                "stopped" % (describe_cmd(cmd), str(timeout)),
+                *logpaths
+            ) from err
     if check and exitval != 0:
         raise ContextualError(
             "SSH command '%s' terminated with a non-zero "
-            "exit status '%d'" % (str(cmd), exitval),
+            "exit status '%d'" % (describe_cmd(cmd), exitval),
             *logpaths
         )
     return exitval
@@ -571,34 +917,123 @@ class PrivateBladeSSHConnection(BladeSSHConnection, PrivateBladeConnection):
     using SSH.
 
     """
+    __slots__ = (
+        'options', 'private_key_path', 'control_dir', 'jinja_values',
+        'scp_prefix', 'ssh_prefix',
+    )
+
     def __init__(
         self,
         common, blade_type, instance,  private_key_path, remote_port=22,
         **kwargs
     ):
-        PrivateBladeConnection.__init__(
-            self,
-            common, blade_type, instance, remote_port
-        )
+        # The SSH options that have nothing to do with the tunnel are
+        # settled before the tunnel is started. The ones that depend
+        # on the tunnel are added by __use_tunnel() once it is up.
         default_opts = [
             '-o', 'BatchMode=yes',
             '-o', 'NoHostAuthenticationForLocalhost=yes',
             '-o', 'StrictHostKeyChecking=no',
         ]
-        port_opt = [
-            '-o', 'Port=%s' % str(self.loc_port),
-        ]
-        self.options = kwargs.get('options', default_opts)
-        self.options += port_opt
+        self.options = tuple(kwargs.get('options', default_opts))
         self.private_key_path = private_key_path
+        # No SSH master connection until the tunnel is up (see
+        # _disconnect()).
+        self.control_dir = None
+        PrivateBladeConnection.__init__(
+            self,
+            common, blade_type, instance, remote_port
+        )
+        self.__use_tunnel()
+
+    def __use_tunnel(self):
+        """class private: Set up everything that depends on the
+        current tunnel (local port) to the blade: the SSH master
+        connection control socket, the leading part of every 'scp'
+        and 'ssh' command run over this connection, and the values
+        available to templated commands.
+
+        """
+        # Share one SSH session to the blade among all of the 'ssh'
+        # and 'scp' commands run over this connection, so only the
+        # first one pays for the SSH handshake. The control socket
+        # lives in a short private directory, since socket paths are
+        # limited in length, and the master is shut down when the
+        # connection is dropped.
+        self.control_dir = mkdtemp(prefix='vtds-ssh-')
+        tunnel_opts = (
+            '-o', 'Port=%s' % str(self.loc_port),
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=%s' % path_join(self.control_dir, 'mux'),
+            '-o', 'ControlPersist=600',
+        )
+        # The leading part of every 'scp' and 'ssh' command run over
+        # this connection is the same, so build it once. For 'ssh'
+        # that includes the target, leaving only the command itself.
+        self.scp_prefix = (
+            tool_path('scp'), '-i', self.private_key_path,
+            *self.options, *tunnel_opts
+        )
+        self.ssh_prefix = (
+            tool_path('ssh'), '-i', self.private_key_path,
+            *self.options, *tunnel_opts,
+            'root@%s' % self.loc_ip
+        )
+        self.jinja_values = {
+            'blade_type': self.b_type,
+            'instance': self.instance,
+            'blade_hostname': self.hostname,
+            'remote_port': self.rem_port,
+            'local_ip': self.loc_ip,
+            'local_port': self.loc_port
+        }
+
+    def _disconnect(self):
+        """Layer private operation: shut down the shared SSH session
+        (if any) then drop the connection.
+
+        """
+        if self.control_dir is not None:
+            # Ask the master to exit. If no master was ever started
+            # this simply fails, which is fine. Don't let a wedged
+            # master hold up the disconnect, give it the same grace
+            # period as the tunnel and move on (run() kills the
+            # command if it times out).
+            try:
+                run(
+                    [
+                        tool_path('ssh'), '-O', 'exit',
+                        '-o', 'ControlPath=%s' % path_join(
+                            self.control_dir, 'mux'
+                        ),
+                        'root@%s' % self.loc_ip
+                    ],
+                    check=False,
+                    timeout=2
+                )
+            except TimeoutExpired:
+                pass
+            rmtree(self.control_dir, ignore_errors=True)
+            self.control_dir = None
+        PrivateBladeConnection._disconnect(self)
 
     def __run(
-        self, cmd, blocking=True, out_path=None, err_path=None,  **kwargs
+        self, cmd, blocking=True, out_path=None, err_path=None, check=True,
+        **kwargs
     ):
         """Run an arbitrary command under Popen() either synchronously
         or asynchronously letting exceptions bubble up to the caller.
+        The 'check' argument is only used when blocking, to decide
+        whether a non-zero exit is an error. It is not passed to
+        Popen(), which does not accept it. Any other keyword
+        arguments are passed to Popen().
 
         """
+        # Everything this process opens is non-inheritable (PEP 446),
+        # so there is nothing for the child to close, and skipping the
+        # close lets subprocess use the cheaper posix_spawn() path.
+        # Callers can still override this.
+        kwargs.setdefault('close_fds', False)
         with logfile(out_path) as out_file, logfile(err_path) as err_file:
             if blocking:
                 with Popen(
@@ -607,7 +1042,7 @@ class PrivateBladeSSHConnection(BladeSSHConnection, PrivateBladeConnection):
                         **kwargs
                 ) as subprocess:
                     return wait_for_popen(
-                        subprocess, cmd, (out_path, err_path), None, **kwargs
+                        subprocess, cmd, (out_path, err_path), None, check
                     )
             else:
                 return Popen(
@@ -619,20 +1054,18 @@ class PrivateBladeSSHConnection(BladeSSHConnection, PrivateBladeConnection):
     def _render_cmd(self, cmd):
         """Layer private: render the specified command string with
         Jinja to fill in the BladeSSHConnection specific data in a
-        templated command.
+        templated command. Commands that contain no Jinja syntax
+        would come out of Jinja unchanged, so they are returned as
+        they are without rendering.
 
         """
-        jinja_values = {
-            'blade_type': self.b_type,
-            'instance': self.instance,
-            'blade_hostname': self.hostname,
-            'remote_port': self.rem_port,
-            'local_ip': self.loc_ip,
-            'local_port': self.loc_port
-        }
+        template = prepare_cmd(cmd)
+        if template is None:
+            return cmd
+        # pylint: disable=import-outside-toplevel
+        from jinja2 import TemplateError
         try:
-            template = Template(cmd)
-            return template.render(**jinja_values)
+            return template.render(self.jinja_values)
         except TemplateError as err:
             raise ContextualError(
                 "error using Jinja to render command line '%s' - %s" % (
@@ -675,13 +1108,10 @@ class PrivateBladeSSHConnection(BladeSSHConnection, PrivateBladeConnection):
             logname if logname is not None else
             "copy-to-%s-%s" % (source, destination)
         )
-        logfiles = log_paths(
-            self.common.build_dir(),
-            "%s-%s" % (logname, self.blade_hostname())
-        )
+        logfiles = self._log_paths(logname)
         recurse_option = ['-r'] if recurse else []
         cmd = [
-            'scp', '-i', self.private_key_path, *recurse_option, *self.options,
+            *self.scp_prefix, *recurse_option,
             source,
             'root@%s:%s' % (self.loc_ip, destination)
         ]
@@ -695,7 +1125,8 @@ class PrivateBladeSSHConnection(BladeSSHConnection, PrivateBladeConnection):
             raise ContextualError(
                 "failed to copy file '%s' to 'root@%s:%s' "
                 "using command: %s - %s" % (
-                    source, self.hostname, destination, str(cmd), str(err)
+                    source, self.hostname, destination, shell_join(cmd),
+                    str(err)
                 ),
                 *logfiles
             ) from err
@@ -734,13 +1165,10 @@ class PrivateBladeSSHConnection(BladeSSHConnection, PrivateBladeConnection):
             logname if logname is not None else
             "copy-from-%s-%s" % (source, destination)
         )
-        logfiles = log_paths(
-            self.common.build_dir(),
-            "%s-%s" % (logname, self.blade_hostname())
-        )
+        logfiles = self._log_paths(logname)
         recurse_option = ['-r'] if recurse else []
         cmd = [
-            'scp', '-i', self.private_key_path, *recurse_option, *self.options,
+            *self.scp_prefix, *recurse_option,
             'root@%s:%s' % (self.loc_ip, destination),
             source
         ]
@@ -754,7 +1182,8 @@ class PrivateBladeSSHConnection(BladeSSHConnection, PrivateBladeConnection):
             raise ContextualError(
                 "failed to copy file '%s' from 'root@%s:%s' "
                 "using command: %s - %s" % (
-                    destination, self.hostname, source, str(cmd), str(err)
+                    destination, self.hostname, source, shell_join(cmd),
+                    str(err)
                 ),
                 *logfiles,
             ) from err
@@ -798,10 +1227,7 @@ class PrivateBladeSSHConnection(BladeSSHConnection, PrivateBladeConnection):
         """
         cmd = self._render_cmd(cmd)
         logfiles = logfiles if logfiles is not None else (None, None)
-        ssh_cmd = [
-            'ssh', '-i', self.private_key_path, *self.options,
-            'root@%s' % (self.loc_ip), cmd
-        ]
+        ssh_cmd = [*self.ssh_prefix, cmd]
         try:
             return self.__run(ssh_cmd, blocking, *logfiles, **kwargs)
         except ContextualError:
@@ -829,9 +1255,65 @@ class PrivateBladeSSHConnectionSet(
         """
         PrivateBladeConnectionSet.__init__(self, common, connections)
 
+    @staticmethod
+    def __wait_all(wait_args_list, fail_fast):
+        """class private: Wait for each of the Popen() objects in
+        'wait_args_list', which is a list of wait_for_popen() argument
+        tuples, to complete and return a list of the errors reported
+        (as strings). If 'fail_fast' is True, stop at the first error
+        seen, terminating (and reaping) the remaining Popen() objects,
+        and return only that error.
+
+        """
+        if fail_fast:
+            return PrivateBladeSSHConnectionSet.__wait_first_error(
+                wait_args_list
+            )
+        errors = []
+        for wait_args in wait_args_list:
+            try:
+                wait_for_popen(*wait_args)
+            # pylint: disable=broad-exception-caught
+            except Exception as err:
+                errors.append(str(err))
+        return errors
+
+    @staticmethod
+    def __wait_first_error(wait_args_list):
+        """class private: Wait for all of the Popen() objects in
+        'wait_args_list' (see __wait_all()) at once, so that the first
+        one to fail is seen as soon as it fails, no matter where it is
+        in the list. When one fails, stop (and reap) all of the others
+        and return a list holding only that error. Otherwise return an
+        empty list.
+
+        """
+        if not wait_args_list:
+            return []
+        # Each waiter only sits blocked on its process, so give every
+        # process its own waiter to see failures as they happen.
+        with ThreadPoolExecutor(max_workers=len(wait_args_list)) as pool:
+            futures = [
+                pool.submit(wait_for_popen, *wait_args)
+                for wait_args in wait_args_list
+            ]
+            done, _ = wait_futures(futures, return_when=FIRST_EXCEPTION)
+            failed = [
+                future for future in futures
+                if future in done and future.exception() is not None
+            ]
+            if not failed:
+                return []
+            # Stop the rest so their waiters finish up, then report the
+            # first failure seen.
+            stop_popens(
+                [subprocess for subprocess, _, _ in wait_args_list]
+            )
+            return [str(failed[0].exception())]
+
     def copy_to(
         self, source, destination,
-        recurse=False, logname=None, blade_type=None
+        recurse=False, logname=None, blade_type=None, fail_fast=False
     ):
         """Copy the file at a path on the local machine ('source') to
         a path ('dest') on all of the selected blades (based on
@@ -841,6 +1323,10 @@ class PrivateBladeSSHConnectionSet(
         errors they produce to raise a ContextualError exception
         describing the failures.
 
+        If 'fail_fast' is True, stop at the first failure instead:
+        terminate the copies still running on the other blades and
+        raise a ContextualError describing that failure.
+
         If the 'recurse' option is True and the local file is a
         directory, the directory and all of its descendants will be
         copied.
@@ -872,26 +1358,19 @@ class PrivateBladeSSHConnectionSet(
                     blade_connection.blade_hostname(),
                     destination
                 ),
-                log_paths(
-                    self.common.build_dir(),
-                    "%s-%s" % (logname, blade_connection.blade_hostname())
-                )
+                # This is a layer private operation not really class
+                # private. Treat this reference as friendly.
+                #
+                # pylint: disable=protected-access
+                blade_connection._log_paths(logname)
             )
-            for blade_connection in self.blade_connections
-            if blade_type is None or
-            blade_connection.blade_type() == blade_type
+            for blade_connection in self.list_connections(blade_type)
         ]
         # Go through all of the copy operations and collect (if
         # needed) any errors that are raised by
         # wait_for_popen(). This acts as a barrier, so when we are
         # done, we know all of the copies have completed.
-        errors = []
-        for wait_args in wait_args_list:
-            try:
-                wait_for_popen(*wait_args)
-            # pylint: disable=broad-exception-caught
-            except Exception as err:
-                errors.append(str(err))
+        errors = self.__wait_all(wait_args_list, fail_fast)
         if errors:
             raise ContextualError(
                 "errors reported while copying '%s' to '%s' on %s\n"
@@ -904,7 +1383,7 @@ class PrivateBladeSSHConnectionSet(
                 )
             )
 
-    def run_command(self, cmd, logname=None, blade_type=None):
+    def run_command(self, cmd, logname=None, blade_type=None, fail_fast=False):
         """Using SSH, run the command in the string 'cmd'
         asynchronously on all connected blades filtered by
         'blade_type'. If 'blade_type' is unspecified or None, run on
@@ -925,6 +1404,10 @@ class PrivateBladeSSHConnectionSet(
         commands fail, collect the errors they produce to raise a
         ContextualError exception describing the failures.
 
+        If 'fail_fast' is True, stop at the first failure instead:
+        terminate the commands still running on the other blades and
+        raise a ContextualError describing that failure.
+
         If the 'logname' argument is provided, use the string found
         there to compose paths to two files, one that will contain the
         standard output from the command and one that will contain the
@@ -936,6 +1419,10 @@ class PrivateBladeSSHConnectionSet(
             logname if logname is not None else
             "parallel-run-%s" % (cmd.split()[0])
         )
+        # Compile the command once, up front. Each blade then only
+        # renders it, and a bad template is reported once, before any
+        # of the blade commands have been started.
+        prepare_cmd(cmd)
         # Okay, this is big and weird. It composes the arguments to
         # pass to wait_for_popen() for each copy operation. Note
         # that, normally, the 'cmd' argument in wait_for_popen() is
@@ -943,36 +1430,25 @@ class PrivateBladeSSHConnectionSet(
         # command being run under SSH. This is okay because
         # wait_for_popen() only uses that information for error
         # generation.
-        wait_args_list = [
-            (
-                blade_connection.run_command(
-                    cmd, False,
-                    log_paths(
-                        self.common.build_dir(),
-                        "%s-%s" % (logname, blade_connection.blade_hostname())
-                    )
-                ),
-                cmd,
-                log_paths(
-                    self.common.build_dir(),
-                    "%s-%s" % (logname, blade_connection.blade_hostname())
+        wait_args_list = []
+        for blade_connection in self.list_connections(blade_type):
+            # This is a layer private operation not really class
+            # private. Treat this reference as friendly.
+            #
+            # pylint: disable=protected-access
+            logfiles = blade_connection._log_paths(logname)
+            wait_args_list.append(
+                (
+                    blade_connection.run_command(cmd, False, logfiles),
+                    cmd,
+                    logfiles
                 )
             )
-            for blade_connection in self.blade_connections
-            if blade_type is None or
-            blade_connection.blade_type() == blade_type
-        ]
         # Go through all of the copy operations and collect (if
         # needed) any errors that are raised by
         # wait_for_popen(). This acts as a barrier, so when we are
         # done, we know all of the copies have completed.
-        errors = []
-        for wait_args in wait_args_list:
-            try:
-                wait_for_popen(*wait_args)
-            # pylint: disable=broad-exception-caught
-            except Exception as err:
-                errors.append(str(err))
+        errors = self.__wait_all(wait_args_list, fail_fast)
         if errors:
             raise ContextualError(
                 "errors reported running command '%s' on %s\n"
@@ -1016,3 +1492,19 @@ class PrivateSecrets(Secrets):
 
         """
         return self.secret_manager.read(name)
+
+    def store_batch(self, items):
+        """Store values (strings) in several secrets at once. The
+        'items' argument is a dictionary or an iterable of (name,
+        value) pairs.
+
+        """
+        self.secret_manager.store_batch(items)
+
+    def read_batch(self, names):
+        """Read the values (strings) stored in several named secrets
+        at once and return them as a dictionary indexed by secret
+        name. A secret with no value present maps to None.
+
+        """
+        return self.secret_manager.read_batch(names)
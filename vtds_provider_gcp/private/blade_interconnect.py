@@ -34,6 +34,11 @@ from vtds_base import (
     render_templated_tree
 )
 
+# Where the blade interconnect templates are found in the Terragrunt
+# templates tree, and where they go (under 'terragrunt' and by type
+# name) in the build tree.
+TEMPLATE_SUBPATH = path_join("system", "platform", "blade-interconnect")
+
 
 class BladeInterconnect:
     """Class representing a single blade interconnect type as defined
@@ -119,16 +124,12 @@ class BladeInterconnect:
         interconnect_config = self.__convert_firewalls(interconnect_config)
 
         # Locate the top of the template for blade_interconnects
-        template_dir = self.terragrunt.template_path(
-            path_join("system", "platform", "blade-interconnect")
-        )
+        template_dir = self.terragrunt.template_path(TEMPLATE_SUBPATH)
 
         # Copy the templates into the build tree before rendering them.
         build_dir = self.terragrunt.add_subtree(
             template_dir,
-            path_join(
-                "terragrunt", "system", "platform", "blade-interconnect", key
-            )
+            path_join("terragrunt", TEMPLATE_SUBPATH, key)
         )
 
         # Compose the data to be used in rendering the templated files.
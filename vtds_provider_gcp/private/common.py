@@ -24,10 +24,27 @@
 and so forth that relate to the GCP vTDS provider.
 
 """
+from json import (
+    dump,
+    load
+)
+from os import (
+    R_OK,
+    access,
+    environ,
+    fdopen,
+    makedirs,
+    replace,
+    unlink
+)
 from os.path import join as path_join
 from subprocess import (
-    PIPE
+    PIPE,
+    TimeoutExpired
 )
+from tempfile import mkstemp
+from threading import Lock
+from time import time
 
 from vtds_base import (
     ContextualError,
@@ -35,6 +52,15 @@ from vtds_base import (
     log_paths
 )
 
+# The file (in the build directory) where project IDs that have been
+# looked up are remembered between runs, indexed by project name.
+PROJECT_ID_CACHE = "project-id-cache.json"
+
+# How long (in seconds) a remembered project ID is trusted before it
+# is looked up again, unless 'provider.project.project_id_cache_ttl'
+# says otherwise.
+PROJECT_ID_CACHE_TTL = 24 * 60 * 60
+
 
 class Common:
     """A class that provides common tools based on configuration and
@@ -42,12 +68,14 @@ class Common:
 
     """
     # For caching purposes, once a project ID has been computed it
-    # will be shared among all instances. Worst case (in case of
-    # multi-threading) we compute this twice before one of the threads
-    # assigns a value to it. The value will be the same no matter who
-    # assigns it, and assignment itself should be atomic, so no real
-    # threading issues to worry about.
+    # will be shared among all instances. Looking it up is done while
+    # holding 'project_id_lock', so that threads that all need it at
+    # once (for example when blade connections are being set up in
+    # parallel) wait for a single lookup instead of each running
+    # their own 'gcloud' command. Once it is known, reading it needs
+    # no lock.
     project_id = None
+    project_id_lock = Lock()
 
     def __init__(self, config, build_dir):
         """Constructor.
@@ -55,12 +83,35 @@ class Common:
         """
         self.config = config
         self.build_directory = build_dir
+        # The log directory is created the first time it is asked for
+        # (see log_dir()).
+        self.logs_dir = None
+        # The zone is looked up once, the first time it is needed
+        # (see get_zone()).
+        self.zone = None
+        # The environment every 'gcloud' command is run in (see
+        # gcloud_env()).
+        self.gcloud_environment = dict(
+            environ, CLOUDSDK_CORE_DISABLE_PROMPTS='1'
+        )
+        # Lookup tables for the per-blade values that get asked for
+        # over and over again (once per blade for every connection
+        # set, for example). They are filled in as values are looked
+        # up, and they must be cleared (see clear_cache()) any time the
+        # blade configuration changes.
+        self.blades = {}
+        self.interconnects = {}
+        self.hostnames = {}
+        self.ip_addrs = {}
+        self.counts = {}
 
     def __get_blade(self, blade_type):
         """class private: retrieve the blade type deascription for the
         named type.
 
         """
+        if blade_type in self.blades:
+            return self.blades[blade_type]
         virtual_blades = (
             self.config.get('virtual_blades', {})
         )
@@ -73,6 +124,19 @@ class Common:
             raise ContextualError(
                 "blade type '%s' is a pure pure base class" % blade_type
             )
+        # Settle the instance count while validating the blade type,
+        # so nothing after this needs to convert it again.
+        try:
+            count = int(blade.get('count', 0))
+        except (TypeError, ValueError) as err:
+            raise ContextualError(
+                "provider config error: the 'count' of Virtual Blade "
+                "type '%s' must be an integer not '%s'" % (
+                    blade_type, blade.get('count')
+                )
+            ) from err
+        self.counts[blade_type] = count
+        self.blades[blade_type] = blade
         return blade
 
     def __get_blade_interconnect(self, blade_type, interconnect):
@@ -80,6 +144,9 @@ class Common:
         the specified Virtual Blade type.
 
         """
+        key = (blade_type, interconnect)
+        if key in self.interconnects:
+            return self.interconnects[key]
         blade = self.__get_blade(blade_type)
         blade_interconnect = blade.get('blade_interconnect', None)
         if blade_interconnect is None:
@@ -92,11 +159,14 @@ class Common:
                 "Virtual Blade type '%s' is not configured to use "
                 "blade interconnect '%s'" % (blade_type, interconnect)
             )
+        self.interconnects[key] = blade_interconnect
         return blade_interconnect
 
     def __check_blade_instance(self, blade_type, instance):
         """class private: Ensure that the specified instance number
-        for a given blade type (blades) is legal.
+        for a given blade type (blades) is legal. Return the blade
+        type description and its instance count so the caller does
+        not need to look them up again.
 
         """
         if not isinstance(instance, int):
@@ -105,13 +175,28 @@ class Common:
                 type(instance)
             )
         blade = self.__get_blade(blade_type)
-        count = int(blade.get('count', 0))
+        # Looking up the blade type settled its count.
+        count = self.counts[blade_type]
         if instance < 0 or instance >= count:
             raise ContextualError(
                 "instance number %d out of range for Virtual Blade "
                 "type '%s' which has a count of %d" %
                 (instance, blade_type, count)
             )
+        return blade, count
+
+    def clear_cache(self):
+        """Layer private: discard any per-blade values that have been
+        looked up and remembered so far. This needs to be called
+        whenever the blade configuration is changed (for example
+        by expanding inheritance) so that stale values are not used.
+
+        """
+        self.blades.clear()
+        self.interconnects.clear()
+        self.hostnames.clear()
+        self.ip_addrs.clear()
+        self.counts.clear()
 
     def get_config(self):
         """Get the full config data stored here.
@@ -132,6 +217,119 @@ class Common:
         """
         return self.build_directory
 
+    def __required_setting(self, section, key):
+        """class private: Return the value of the setting 'key' in the
+        top level section 'section' of the provider configuration,
+        raising a ContextualError if it is not there.
+
+        """
+        value = self.config.get(section, {}).get(key, None)
+        if value is None:
+            raise ContextualError(
+                "provider config error: cannot find '%s' in "
+                "'provider.%s'" % (key, section)
+            )
+        return value
+
+    def project_name(self):
+        """Layer private: Compose the name of the vTDS project from
+        the configured organization name and project base name.
+
+        """
+        return "%s-%s" % (
+            self.__required_setting('organization', 'name'),
+            self.__required_setting('project', 'base_name')
+        )
+
+    def __project_id_cache_ttl(self):
+        """class private: Return the configured number of seconds a
+        project ID stays in the cache kept between runs, raising a
+        ContextualError if it is not a non-negative number.
+
+        """
+        ttl = self.config.get('project', {}).get(
+            'project_id_cache_ttl', PROJECT_ID_CACHE_TTL
+        )
+        if isinstance(ttl, bool) or not isinstance(ttl, (int, float)) \
+           or ttl < 0:
+            raise ContextualError(
+                "provider config error: 'provider.project."
+                "project_id_cache_ttl' must be a non-negative number "
+                "of seconds, not '%s'" % str(ttl)
+            )
+        return ttl
+
+    def __read_project_id_cache(self):
+        """class private: Read the project IDs remembered from
+        previous runs. If there is no usable cache, return an empty
+        one.
+
+        """
+        try:
+            with open(
+                    path_join(self.build_directory, PROJECT_ID_CACHE),
+                    'r', encoding='UTF-8'
+            ) as cache_file:
+                cache = load(cache_file)
+        except (OSError, ValueError):
+            return {}
+        return cache if isinstance(cache, dict) else {}
+
+    def __write_project_id_cache(self, cache):
+        """class private: Replace the remembered project IDs with the
+        contents of 'cache'. The new file is written to the side and
+        then moved into place so that a reader never sees a partially
+        written cache. Failing to write the cache is not an error,
+        the next run will just have to look the project ID up again.
+
+        """
+        try:
+            makedirs(self.build_directory, exist_ok=True)
+            tmp_fd, tmp_path = mkstemp(
+                dir=self.build_directory, prefix=PROJECT_ID_CACHE
+            )
+            try:
+                with fdopen(tmp_fd, 'w', encoding='UTF-8') as cache_file:
+                    dump(cache, cache_file)
+                replace(
+                    tmp_path,
+                    path_join(self.build_directory, PROJECT_ID_CACHE)
+                )
+            except OSError:
+                unlink(tmp_path)
+                raise
+        except OSError:
+            pass
+
+    def gcloud_env(self):
+        """Layer private: Return the environment to run 'gcloud'
+        commands in. This is the caller's environment with prompting
+        turned off, so that no 'gcloud' command this layer runs can
+        ever stop and wait for an answer that is not coming.
+
+        """
+        return self.gcloud_environment
+
+    def log_dir(self):
+        """Layer private: Return the path to the directory where logs
+        are kept, the same one vtds_base.log_paths() uses. The
+        directory is created the first time it is asked for, after
+        that the path is just returned.
+
+        """
+        if self.logs_dir is None:
+            logs = path_join(self.build_directory, "logs")
+            try:
+                makedirs(logs, mode=0o755, exist_ok=True)
+            except OSError as err:
+                raise ContextualError(
+                    "failed to create log directory '%s' - %s" % (
+                        logs, str(err)
+                    )
+                ) from err
+            self.logs_dir = logs
+        return self.logs_dir
+
     def get_project_id(self):
         """layer private: Retrieve the project ID for the current vTDS
         project.
@@ -139,64 +337,116 @@ class Common:
         """
         if self.project_id is not None:
             return self.project_id
-        organization_name = (
-            self.config.get('organization', {}).get('name', None)
-        )
-        if organization_name is None:
-            raise ContextualError(
-                "provider config error: cannot find 'name' in "
-                "'provider.organization'"
+        with Common.project_id_lock:
+            # Another thread may have looked it up while this one was
+            # waiting for the lock.
+            if self.project_id is not None:
+                return self.project_id
+            return self.__look_up_project_id()
+
+    def __look_up_project_id(self):
+        """class private: Look up the project ID for the current vTDS
+        project, first in the cache kept between runs, then using
+        'gcloud'. Must be called with the project ID lock held.
+
+        """
+        project_name = self.project_name()
+        # Looking the project ID up takes a 'gcloud' call, so use the
+        # one found by a previous run if there is one.
+        cache = self.__read_project_id_cache()
+        ttl = self.__project_id_cache_ttl()
+        entry = cache.get(project_name, None)
+        try:
+            project_id = entry['project_id']
+            cached_at = float(entry['cached_at'])
+        except (KeyError, TypeError, ValueError):
+            # No entry, or not one this version wrote, look it up.
+            project_id = None
+        if project_id is not None and 0 <= time() - cached_at < ttl:
+            # Reference the class variable using the class name to
+            # set it.
+            Common.project_id = project_id
+            return self.project_id
+        logs = log_paths(self.build_directory, "common-get-project-id")
+        cmd = [
+            'gcloud', 'projects', 'list',
+            '--filter=name=%s' % project_name,
+            '--format=value(PROJECT_ID)',
+            '--quiet', '--verbosity=error'
+        ]
+        # A project that does not exist (yet) is not an error, the
+        # list is simply empty. If 'gcloud' itself fails, though, say
+        # so instead of treating the project as missing.
+        try:
+            result = run(
+                cmd, logs,
+                stdout=PIPE, timeout=120, env=self.gcloud_env()
             )
-        base_name = (
-            self.config.get('project', {}).get('base_name', None)
-        )
-        if base_name is None:
+        except TimeoutExpired as err:
+            raise ContextualError(
+                "timed out looking up the project ID of project '%s' "
+                "using command: %s" % (project_name, " ".join(cmd)),
+                *logs
+            ) from err
+        project_ids = result.stdout.split()
+        if len(project_ids) > 1:
             raise ContextualError(
-                "provider config error: cannot find 'base_name' in "
-                "'provider.project'"
+                "found more than one project named '%s' - %s" % (
+                    project_name, str(project_ids)
+                ),
+                *logs
             )
-        project_name = "%s-%s" % (organization_name, base_name)
-        result = run(
-            [
-                'gcloud', 'projects', 'list',
-                '--filter=name=%s' % project_name,
-                '--format=value(PROJECT_ID)'
-            ],
-            log_paths(self.build_directory, "common-get-project-id"),
-            stdout=PIPE,
-            check=False
-        )
         # Reference the class variable using the class name to set it.
-        Common.project_id = result.stdout.rstrip()
-        Common.project_id = Common.project_id if Common.project_id else None
+        Common.project_id = project_ids[0] if project_ids else None
+        if self.project_id is not None:
+            cache[project_name] = {
+                'project_id': self.project_id,
+                'cached_at': time(),
+            }
+            self.__write_project_id_cache(cache)
         return self.project_id
 
+    def forget_project_id(self):
+        """Layer private: Forget the project ID for the current vTDS
+        project, both here and in the cache kept between runs. This
+        needs to be called when the project is removed, since a
+        project created later with the same name will have a
+        different ID.
+
+        """
+        with Common.project_id_lock:
+            # Reference the class variable using the class name to set
+            # it.
+            Common.project_id = None
+            project_name = self.project_name()
+            cache = self.__read_project_id_cache()
+            if project_name in cache:
+                del cache[project_name]
+                self.__write_project_id_cache(cache)
+
     def get_zone(self):
         """Layer private: get the configured zone in which resources
         for this project reside.
 
         """
-        zone = self.config.get('project', {}).get('zone', None)
-        if zone is None:
-            raise ContextualError(
-                "provider config error: cannot find 'zone' in "
-                "'provider.project'"
-            )
-        return zone
+        if self.zone is None:
+            self.zone = self.__required_setting('project', 'zone')
+        return self.zone
 
     def blade_hostname(self, blade_type, instance):
         """Get the hostname of a given instance of the specified type
         of Virtual Blade.
 
         """
-        self.__check_blade_instance(blade_type, instance)
-        blade = self.__get_blade(blade_type)
+        key = (blade_type, instance)
+        if key in self.hostnames:
+            return self.hostnames[key]
+        blade, count = self.__check_blade_instance(blade_type, instance)
         if 'hostname' not in blade:
             raise ContextualError(
                 "provider config error: no 'hostname' configured for "
                 "Virtual Blade type '%s'" % blade_type
             )
-        count = self.blade_count(blade_type)
         add_suffix = blade.get('add_hostname_suffix', count > 1)
         hostname = blade['hostname']
         separator = (
@@ -204,7 +454,8 @@ class Common:
         )
         # Suffixes are 1 based, not 0 based, instances are 0 based
         suffix = "%3.3d" % (instance + 1) if add_suffix else ""
-        return hostname + separator + suffix
+        self.hostnames[key] = hostname + separator + suffix
+        return self.hostnames[key]
 
     def blade_ip(self, blade_type, instance, interconnect):
         """Return the IP address (string) on the named Blade
@@ -212,7 +463,10 @@ class Common:
         Blade type.
 
         """
-        self.__check_blade_instance(blade_type, instance)
+        key = (blade_type, instance, interconnect)
+        if key in self.ip_addrs:
+            return self.ip_addrs[key]
+        _, count = self.__check_blade_instance(blade_type, instance)
         blade_interconnect = self.__get_blade_interconnect(
             blade_type, interconnect
         )
@@ -220,23 +474,26 @@ class Common:
         if not ip_addrs:
             raise ContextualError(
                 "provider config error: Virtual Blade type '%s' has no "
-                "'ip_addrs' configured"
+                "'ip_addrs' configured" % blade_type
             )
         if instance >= len(ip_addrs):
             raise ContextualError(
                 "provider config error: Virtual Blade type is configured with "
                 "fewer ip_addrs (%d) than blade instances (%d)" %
-                (len(ip_addrs), self.blade_count(blade_type))
+                (len(ip_addrs), count)
             )
-        return ip_addrs[instance]
+        self.ip_addrs[key] = ip_addrs[instance]
+        return self.ip_addrs[key]
 
     def blade_count(self, blade_type):
         """Get the number of Virtual Blade instances of the specified
         type.
 
         """
-        blade = self.__get_blade(blade_type)
-        return int(blade.get('count', 0))
+        if blade_type not in self.counts:
+            # Validating the blade type settles its count.
+            self.__get_blade(blade_type)
+        return self.counts[blade_type]
 
     def blade_interconnects(self, blade_type):
         """Return the list of Blade Interconnects by name connected to
@@ -287,16 +544,13 @@ class Common:
         private_path = path_join(ssh_dir, "id_rsa")
         public_path = path_join(ssh_dir, "id_rsa.pub")
         if not ignore_missing:
-            try:
-                # Verify that we can open both paths. No need to do
-                # anything with them.
-                with open(public_path, 'r', encoding='UTF-8') as _:
-                    pass
-                with open(private_path, 'r', encoding='UTF-8') as _:
-                    pass
-            except OSError as err:
-                raise ContextualError(
-                    "failed to open SSH key file for reading "
-                    "(verification) - %s" % str(err)
-                ) from err
+            # Verify that both files can be read, without actually
+            # opening them.
+            for path in (public_path, private_path):
+                if not access(path, R_OK):
+                    raise ContextualError(
+                        "failed to open SSH key file for reading "
+                        "(verification) - '%s' is missing or not "
+                        "readable" % path
+                    )
         return (public_path, private_path)
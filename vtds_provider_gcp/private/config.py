@@ -28,7 +28,10 @@ configuration.
 from os.path import join as path_join
 import yaml
 from vtds_base import ContextualError
-from . import CONFIG_DIR
+from . import (
+    CONFIG_DIR,
+    YAMLLoader
+)
 
 
 class PrivateBaseConfig:
@@ -50,7 +53,7 @@ class PrivateBaseConfig:
         config = path_join(CONFIG_DIR, "config.yaml")
         try:
             with open(config, 'r', encoding='UTF-8') as config_stream:
-                return yaml.safe_load(config_stream)
+                return yaml.load(config_stream, Loader=YAMLLoader)
         except OSError as err:
             raise ContextualError(
                 "cannot open GCP provider base config file  '%s' - %s" % (
@@ -90,7 +93,7 @@ class PrivateBaseConfig:
         config = path_join(CONFIG_DIR, "test_overlay.yaml")
         try:
             with open(config, 'r', encoding='UTF-8') as config_stream:
-                return yaml.safe_load(config_stream)
+                return yaml.load(config_stream, Loader=YAMLLoader)
         except OSError as err:
             raise ContextualError(
                 "cannot open GCP provider test config overlay file "
@@ -24,12 +24,13 @@
 
 """
 import os
+from concurrent.futures import ThreadPoolExecutor
 from os.path import dirname
 from os import makedirs
 from shutil import rmtree
 from yaml import (
-    safe_load,
-    safe_dump
+    dump,
+    load
 )
 
 from vtds_base import (
@@ -52,8 +53,16 @@ from .api_objects import (
     PrivateSecrets
 )
 from .common import Common
+from . import (
+    YAMLLoader,
+    YAMLDumper
+)
 from .secret_manager import SecretManager
 
+# The most Virtual Blade types installed in the Terragrunt tree at
+# once during prepare().
+MAX_PREPARE_THREADS = 16
+
 
 class PrivateProvider:
     """PrivateProvider class, implements the GCP provider layer
@@ -72,6 +81,21 @@ class PrivateProvider:
         self.secret_manager = SecretManager(self.common)
         self.stack = stack
         self.prepared = False
+        # The API objects handed out by the get_*() methods, built the
+        # first time they are asked for (see __forget_api_objects()).
+        self.virtual_blades = None
+        self.blade_interconnects = None
+        self.secrets = None
+
+    def __forget_api_objects(self):
+        """Class private: drop the API objects built so far so that the
+        next get_*() call builds new ones from the current
+        configuration.
+
+        """
+        self.virtual_blades = None
+        self.blade_interconnects = None
+        self.secrets = None
 
     def __read_key_secrets(self, secret_name):
         """Read SSH keys back from an SSH keys directory in the build
@@ -115,7 +139,7 @@ class PrivateProvider:
         ssh_dir = dirname(priv_key)
         rmtree(ssh_dir, ignore_errors=True)
         makedirs(ssh_dir, mode=0o700, exist_ok=True)
-        keys = safe_load(secret_data)
+        keys = load(secret_data, Loader=YAMLLoader)
 
         # Make sure that the file is created with owner only 'rw'
         # permissions.
@@ -132,11 +156,45 @@ class PrivateProvider:
             priv_key_file.write("%s\n" % keys['private'])
         return keys
 
-    def __add_ssh_key(self, blade_type, blade_config):
-        """Add the SSH public key from the blade's ssh_key_secret to
-        the blade metadata so that when the blade is deployed it will
-        have the proper authorized key for SSH access through a blade
-        connection.
+    def __blade_ssh_keys(self, secret_names):
+        """Get the SSH key pairs held in each of the named SSH key
+        secrets into the build tree, generating a new key pair for any
+        secret that has no value yet. Return a dictionary of the key
+        pairs indexed by secret name. Each secret is handled only
+        once, however many blade types share it, and the secrets are
+        handled concurrently since key generation is slow.
+
+        """
+        secret_data = self.secret_manager.read_batch(secret_names)
+        workers = max(1, min(MAX_PREPARE_THREADS, len(secret_names)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return dict(
+                zip(
+                    secret_names,
+                    executor.map(
+                        self.__ssh_keys_for_secret,
+                        secret_names,
+                        [secret_data[name] for name in secret_names]
+                    )
+                )
+            )
+
+    def __ssh_keys_for_secret(self, secret_name, secret_data):
+        """Get the SSH key pair held in 'secret_data' (the value of
+        the named secret) into the build tree, or generate a new key
+        pair there if 'secret_data' is None. Return the key pair.
+
+        """
+        return (
+            self.__cache_ssh_keys(secret_data, secret_name)
+            if secret_data is not None
+            else self.__generate_blade_ssh_keys(secret_name)
+        )
+
+    @staticmethod
+    def __ssh_key_secret(blade_type, blade_config):
+        """Return the name of the SSH key secret used by a blade type
+        given its configuration.
 
         """
         secret_name = blade_config.get("ssh_key_secret", None)
@@ -145,12 +203,16 @@ class PrivateProvider:
                 "provider config error: no 'ssh_key_secret' "
                 "found in blade type '%s'" % blade_type
             )
-        secret_data = self.secret_manager.read(secret_name)
-        keys = (
-            self.__cache_ssh_keys(secret_data, secret_name)
-            if secret_data is not None
-            else self.__generate_blade_ssh_keys(secret_name)
-        )
+        return secret_name
+
+    @staticmethod
+    def __add_ssh_key(blade_config, keys):
+        """Add the SSH public key from 'keys' (the key pair from the
+        blade's ssh_key_secret) to the blade metadata so that when the
+        blade is deployed it will have the proper authorized key for
+        SSH access through a blade connection.
+
+        """
         # This weird little dance makes sure that 'metadata' is in
         # blade_config and has a sub-KV pair 'metadata' where we can
         # put the SSH public key(s).
@@ -175,9 +237,14 @@ class PrivateProvider:
             virtual_blades.blade_ssh_key_secret(blade_type)
             for blade_type in virtual_blades.blade_types()
         }
-        for secret_name in secret_names:
-            keys = self.__read_key_secrets(secret_name)
-            self.secret_manager.store(secret_name, safe_dump(keys))
+        self.secret_manager.store_batch(
+            {
+                secret_name: dump(
+                    self.__read_key_secrets(secret_name), Dumper=YAMLDumper
+                )
+                for secret_name in secret_names
+            }
+        )
 
     def prepare(self):
         """Prepare operation. This drives creation of the provider
@@ -192,6 +259,13 @@ class PrivateProvider:
             raise ContextualError(
                 "no virtual blade types found in vTDS provider configuration"
             )
+        interconnect_types = self.common.get('blade_interconnects', None)
+        if interconnect_types is None:
+            raise ContextualError(
+                "no blade interconnect types found in vTDS provider "
+                "configuration"
+            )
+        blade_configs = []
         for blade_type in blade_types:
             # Expand the inheritance tree for the blade type and put
             # the expanded result back into the configuration. That
@@ -205,39 +279,64 @@ class PrivateProvider:
             blade_config = expand_inheritance(
                 blade_types, blade_type
             )
-            virtual_blade = VirtualBlade(self.terragrunt)
-            blade_config = virtual_blade.initialize(
-                blade_type, blade_config
-            )
-            self.__add_ssh_key(blade_type, blade_config)
             blade_types[blade_type] = blade_config
-        interconnect_types = self.common.get('blade_interconnects', None)
-        if interconnect_types is None:
-            raise ContextualError(
-                "no blade interconnect types found in vTDS provider "
-                "configuration"
-            )
-        for interconnect_type in interconnect_types:
-            if interconnect_types[interconnect_type].get(
-                    'pure_base_class', False
-            ):
-                # Skip inheritance and installation for pure base
-                # classes since they have no parents, and they aren't
-                # used for deployment.
-                continue
-            interconnect_config = expand_inheritance(
-                interconnect_types, interconnect_type
-            )
-            blade_interconnect = BladeInterconnect(self.terragrunt)
-            interconnect_config = blade_interconnect.initialize(
-                interconnect_type, interconnect_config
-            )
-            interconnect_types[interconnect_type] = interconnect_config
+            blade_configs.append((blade_type, blade_config))
+        # Several blade types may share an SSH key secret, so get the
+        # key pairs for each distinct secret first, then hand them out
+        # to the blade types.
+        key_secrets = [
+            self.__ssh_key_secret(blade_type, blade_config)
+            for blade_type, blade_config in blade_configs
+        ]
+        ssh_keys = self.__blade_ssh_keys(list(dict.fromkeys(key_secrets)))
+        for (_, blade_config), secret_name in zip(blade_configs, key_secrets):
+            self.__add_ssh_key(blade_config, ssh_keys[secret_name])
+        # Installing a blade type in the Terragrunt tree is mostly
+        # copying and rendering files and leaves the blade
+        # configuration alone, so do all of those at once in the
+        # background while the interconnects are set up.
+        workers = max(1, min(MAX_PREPARE_THREADS, len(blade_configs)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    VirtualBlade(self.terragrunt).initialize,
+                    blade_type, blade_config
+                )
+                for blade_type, blade_config in blade_configs
+            ]
+            # Installing an interconnect type rewrites its firewall
+            # rules in place, and interconnect types can share those
+            # through inheritance, so these are done one at a time.
+            for interconnect_type in interconnect_types:
+                if interconnect_types[interconnect_type].get(
+                        'pure_base_class', False
+                ):
+                    # Skip inheritance and installation for pure base
+                    # classes since they have no parents, and they
+                    # aren't used for deployment.
+                    continue
+                interconnect_config = expand_inheritance(
+                    interconnect_types, interconnect_type
+                )
+                blade_interconnect = BladeInterconnect(self.terragrunt)
+                interconnect_config = blade_interconnect.initialize(
+                    interconnect_type, interconnect_config
+                )
+                interconnect_types[interconnect_type] = interconnect_config
+        # Report the first blade type that failed to install (if any).
+        for future in futures:
+            future.result()
         # Now that we have fully expanded all of the inheritance and
         # set up the terragrunt controls for everything that is going
         # to get them, set up the terragrunt configuration.
         self.terragrunt_config.initialize()
 
+        # Expanding inheritance above replaced the blade
+        # configurations, so drop anything that was looked up from
+        # them along the way.
+        self.common.clear_cache()
+        self.__forget_api_objects()
+
         # All done with the preparations: make a note that we have
         # done them and return.
         self.prepared = True
@@ -320,24 +419,32 @@ class PrivateProvider:
                 "cannot deploy an unprepared provider, call prepare() first"
             )
         self.terragrunt.remove()
+        # The project is gone, so its ID is no longer good.
+        self.common.forget_project_id()
 
     def get_virtual_blades(self):
         """Return a the VirtualBlades object containing all of the
         available non-pure-base-class Virtual Blades.
 
         """
-        return PrivateVirtualBlades(self.common)
+        if self.virtual_blades is None:
+            self.virtual_blades = PrivateVirtualBlades(self.common)
+        return self.virtual_blades
 
     def get_blade_interconnects(self):
         """Return a BladeInterconnects object containing all the
         available non-pure-base-class Blade Interconnects.
 
         """
-        return PrivateBladeInterconnects(self.common)
+        if self.blade_interconnects is None:
+            self.blade_interconnects = PrivateBladeInterconnects(self.common)
+        return self.blade_interconnects
 
     def get_secrets(self):
         """Return a Secrets API object that provides access to all
         available secrets.
 
         """
-        return PrivateSecrets(self.secret_manager)
+        if self.secrets is None:
+            self.secrets = PrivateSecrets(self.secret_manager)
+        return self.secrets
@@ -25,6 +25,7 @@ operations and GCP secret operations.
 
 """
 import re
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import PIPE
 from json import loads
 from vtds_base import (
@@ -33,6 +34,13 @@ from vtds_base import (
     run
 )
 
+# The most 'gcloud' secret operations run at once by the batch
+# operations.
+MAX_SECRET_THREADS = 16
+
+# Find any whitespace in a secret label or annotation key or value.
+HAS_WHITESPACE = re.compile(r"\s").search
+
 
 class SecretManager:
     """Class providing operations for creating and removing secrets as
@@ -59,8 +67,18 @@ class SecretManager:
                 "configuration error: the following secrets (by key) in the "
                 "config do not define a 'name' field: %s" % str(missing_names)
             ) from err
-        self.cache = {}
-        self.__load_cache()
+        # The label and annotation options used to create each secret
+        # only depend on the configuration, so check and build them
+        # once up front.
+        self.create_options = {
+            name: self.__create_options(secret)
+            for name, secret in self.secrets.items()
+        }
+        # The cache is loaded from GCP the first time it is needed
+        # (see __get_cache()) so that constructing a SecretManager,
+        # which happens every time the provider layer is set up,
+        # doesn't cost a round of 'gcloud' calls.
+        self.cache = None
 
     @staticmethod
     def __expand_kvs(secret_name, dict_name, dictionary):
@@ -70,18 +88,85 @@ class SecretManager:
         contain whitespace.
 
         """
-        valid = re.compile(r"^[^\s]*$")
-        result = ""
         for key, value in dictionary.items():
-            if not valid.match(key) or not valid.match(value):
+            if HAS_WHITESPACE(key) or HAS_WHITESPACE(value):
                 raise ContextualError(
                     "secret '%s' has whitespace in '%s' entry ['%s':'%s']" % (
                         secret_name, dict_name, key, value
                     )
                 )
-            result += "," if result else ""
-            result += "%s=%s" % (key, value)
-        return result
+        return ",".join(
+            "%s=%s" % (key, value) for key, value in dictionary.items()
+        )
+
+    @classmethod
+    def __create_options(cls, secret):
+        """Class private: Return the list of options that set the
+        labels and annotations (if any) of the specified secret when
+        it is created.
+
+        """
+        name = secret['name']
+        options = []
+        # Set up the option to add labels if there are any needed
+        if secret.get('labels', None):
+            options.append(
+                "--labels=%s" % cls.__expand_kvs(
+                    name, "labels", secret['labels']
+                )
+            )
+        # Set up the option to add annotations if there are any needed
+        if secret.get('annotations', None):
+            options.append(
+                "--set-annotations=%s" % cls.__expand_kvs(
+                    name, "annotations", secret['annotations']
+                )
+            )
+        return options
+
+    def __project_flag(self):
+        """Class private: Return the '--project' option that points
+        'gcloud' at the vTDS project, or None if the project does not
+        exist (yet).
+
+        """
+        project_name = self.common.get_project_id()
+        return (
+            "--project=%s" % project_name if project_name is not None
+            else None
+        )
+
+    def __required_project_flag(self):
+        """Class private: Return the '--project' option that points
+        'gcloud' at the vTDS project, raising a ContextualError if the
+        project does not exist (yet).
+
+        """
+        project_id = self.__project_flag()
+        if project_id is None:
+            raise ContextualError(
+                "project '%s' does not exist, deploy the provider layer "
+                "before managing its secrets" % self.common.project_name()
+            )
+        return project_id
+
+    def __get_cache(self):
+        """Class private: return the secret cache, loading it from
+        GCP first if that has not been done yet.
+
+        """
+        if self.cache is None:
+            # Set up an empty cache before loading so that the reads
+            # done while loading can use it.
+            self.cache = {}
+            try:
+                self.__load_cache()
+            except Exception:
+                # Don't leave a partially loaded cache behind, try
+                # again next time.
+                self.cache = None
+                raise
+        return self.cache
 
     def __load_cache(self):
         """Pre-load the cache with all of the secrets currently in the
@@ -89,18 +174,18 @@ class SecretManager:
 
         """
         # Nothing in the cache yet, load it up.
-        project_name = self.common.get_project_id()
-        if project_name is None:
+        project_id = self.__project_flag()
+        if project_id is None:
             # No project yet, nothing to load.
             return
-        logname = "load-cache-%s" % project_name
-        project_id = "--project=%s" % project_name
+        logname = "load-cache-%s" % self.common.get_project_id()
         result = run(
             [
                 'gcloud', 'secrets', project_id, 'list', '--format=json'
             ],
             log_paths(self.common.build_dir(), logname),
-            stdout=PIPE
+            stdout=PIPE,
+            env=self.common.gcloud_env()
         )
         secret_list = loads(result.stdout)
         self.cache = {
@@ -118,7 +203,7 @@ class SecretManager:
         # I didn't get here if any of the secrets don't have names, so
         # no need to protect this reference.
         name = secret['name']
-        return name in self.cache
+        return name in self.__get_cache()
 
     def __create_secret(self, secret):
         """Class private: register the specified secret in the GCP
@@ -128,30 +213,18 @@ class SecretManager:
         # I didn't get here if any of the secrets don't have names, so
         # no need to protect this reference.
         name = secret['name']
-        project_id = "--project=%s" % self.common.get_project_id()
-        cmd = ['gcloud', 'secrets', 'create', name, project_id]
-        # Set up the option to add labels if there are any needed
-        labels = (
-            "--labels=%s" % self.__expand_kvs(name, "labels", secret['labels'])
-            if secret.get('labels', None) else
-            ""
-        )
-        if labels:
-            cmd.append(labels)
-        # Set up the option to add annotations if there are any needed
-        annotations = (
-            "--set-annotations=%s" % self.__expand_kvs(
-                name, "annotations", secret['annotations']
-            )
-            if secret.get('annotations', None) else
-            ""
-        )
-        if annotations:
-            cmd.append(annotations)
+        project_id = self.__required_project_flag()
+        cmd = [
+            'gcloud', 'secrets', 'create', name, project_id,
+            *self.create_options[name]
+        ]
         logname = "create-secret-%s" % name
-        run(cmd, log_paths(self.common.build_dir(), logname))
+        run(
+            cmd, log_paths(self.common.build_dir(), logname),
+            env=self.common.gcloud_env()
+        )
         # Newly created, no value yet.
-        self.cache[name] = None
+        self.__get_cache()[name] = None
 
     def __remove_secret(self, secret):
         """Class private: register the specified secret in the GCP
@@ -161,15 +234,16 @@ class SecretManager:
         # I didn't get here if any of the secrets don't have names, so
         # no need to protect this reference.
         name = secret['name']
-        project_id = "--project=%s" % self.common.get_project_id()
+        project_id = self.__required_project_flag()
         logname = "remove-secret-%s" % name
         run(
             ['gcloud', 'secrets', 'delete', name, project_id, '--quiet'],
-            log_paths(self.common.build_dir(), logname)
+            log_paths(self.common.build_dir(), logname),
+            env=self.common.gcloud_env()
         )
         # Take the secret out of the cache if it is there.
         try:
-            del self.cache[name]
+            del self.__get_cache()[name]
         except KeyError:
             pass
 
@@ -181,7 +255,7 @@ class SecretManager:
         # I didn't get here if any of the secrets don't have names, so
         # no need to protect this reference.
         name = secret['name']
-        project_id = "--project=%s" % self.common.get_project_id()
+        project_id = self.__required_project_flag()
         logname = "store-secret-%s" % name
         run(
             [
@@ -189,11 +263,12 @@ class SecretManager:
                 '--data-file=-', name,
             ],
             log_paths(self.common.build_dir(), logname),
-            input=data
+            input=data,
+            env=self.common.gcloud_env()
         )
         # Keep a write-through cache of secrets that have been stored
         # to expedite retrieving them in the future.
-        self.cache[name] = data
+        self.__get_cache()[name] = data
 
     def __read_secret(self, secret):
         """Read the 'latest' version data from the specified secret
@@ -204,29 +279,29 @@ class SecretManager:
         """
         # I didn't get here if any of the secrets don't have names, so
         # no need to protect this reference.
-        name = "--secret=%s" % secret['name']
+        name = secret['name']
         # Try reading the secret from the cache, if it doesn't work go
         # ahead and get it from GCP instead.
-        data = self.cache.get(name, None)
+        data = self.__get_cache().get(name, None)
         if data is not None:
             return data
         # Secret either was not in the cache or had no value in the
         # cache yet. See if it has a value now.
-        project_name = self.common.get_project_id()
-        if project_name is None:
+        project_id = self.__project_flag()
+        if project_id is None:
             # The project doesn't exist (yet) so the secret doesn't
             # have a value.
             return None
-        project_id = "--project=%s" % project_name
-        logname = "read-secret-%s" % secret['name']
+        logname = "read-secret-%s" % name
         result = run(
             [
                 'gcloud', 'secrets', 'versions', 'access', 'latest',
-                project_id, name,
+                project_id, "--secret=%s" % name,
             ],
             log_paths(self.common.build_dir(), logname),
             stdout=PIPE,
-            check=False
+            check=False,
+            env=self.common.gcloud_env()
         )
         if result.returncode != 0:
             # The command failed, assume that either the secret
@@ -236,6 +311,24 @@ class SecretManager:
         self.cache[name] = result.stdout.rstrip()
         return self.cache[name]
 
+    @staticmethod
+    def __run_all(operation, secrets, *other_args):
+        """Class private: Call 'operation(secret, ...)' for each of the
+        secrets in 'secrets' concurrently, since each one is a
+        separate 'gcloud' command. Any further arguments are lists
+        parallel to 'secrets' supplying the rest of the arguments for
+        each call. Return the results as a list in the order of
+        'secrets'. If any of them fail, raise the first error (in the
+        order of 'secrets') once they are all done.
+
+        """
+        if not secrets:
+            return []
+        workers = min(MAX_SECRET_THREADS, len(secrets))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # Run through the results so any error is raised here.
+            return list(pool.map(operation, secrets, *other_args))
+
     def deploy(self):
         """Deploy all secrets declared by any layer during the
         'prepare' phase to the GCP Secret Manager. This creates the
@@ -245,17 +338,38 @@ class SecretManager:
         secrets.
 
         """
-        for _, secret in self.secrets.items():
-            if not self.__check_secret(secret):
-                self.__create_secret(secret)
+        # Load the cache before starting the threads so they don't
+        # all try to load it at once.
+        self.__get_cache()
+        missing = [
+            secret for secret in self.secrets.values()
+            if not self.__check_secret(secret)
+        ]
+        self.__run_all(self.__create_secret, missing)
 
     def remove(self):
         """Remove all secrets declared by any layer during the
         'prepare' phase from the GCP Secret Manager.
 
         """
-        for _, secret in self.secrets.items():
-            self.__remove_secret(secret)
+        # Load the cache before starting the threads so they don't
+        # all try to load it at once.
+        self.__get_cache()
+        self.__run_all(self.__remove_secret, list(self.secrets.values()))
+
+    def __known_secrets(self, names, action):
+        """Class private: look up the secret declarations for all of
+        the names in 'names' and return them as a list in the same
+        order. The 'action' string describes the operation in the
+        error raised if any of the names is not a known secret.
+
+        """
+        unknown = [name for name in names if name not in self.secrets]
+        if unknown:
+            raise ContextualError(
+                "attempt to %s unknown secrets %s" % (action, str(unknown))
+            )
+        return [self.secrets[name] for name in names]
 
     def store(self, name, value):
         """Store a value in the named secret. The value should be a
@@ -279,3 +393,38 @@ class SecretManager:
                 "attempt to read value from an unknown secret '%s'" % name
             )
         return self.__read_secret(secret)
+
+    def store_batch(self, items):
+        """Store values in several secrets at once. The 'items'
+        argument is a dictionary or an iterable of (name, value)
+        pairs. Each value should be a UTF-8 encoded string. The
+        secrets are stored concurrently.
+
+        """
+        pairs = list(dict(items).items())
+        if not pairs:
+            return
+        secrets = self.__known_secrets(
+            [name for name, _ in pairs], "store values in"
+        )
+        # Load the cache before starting the threads so they don't
+        # all try to load it at once.
+        self.__get_cache()
+        self.__run_all(
+            self.__store_secret, secrets, [value for _, value in pairs]
+        )
+
+    def read_batch(self, names):
+        """Read the values of several secrets at once and return them
+        as a dictionary indexed by secret name. The secrets are read
+        concurrently.
+
+        """
+        names = list(names)
+        if not names:
+            return {}
+        secrets = self.__known_secrets(names, "read values from")
+        # Load the cache before starting the threads so they don't
+        # all try to load it at once.
+        self.__get_cache()
+        return dict(zip(names, self.__run_all(self.__read_secret, secrets)))
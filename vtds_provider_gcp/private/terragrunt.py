@@ -30,11 +30,24 @@ supporting elements of a GCP project) on a GCP cloud provider.
 from shutil import (
     copy,
     copytree,
-    rmtree
+    rmtree,
+    which
 )
-from os.path import join as path_join
+from contextlib import contextmanager
+import os
+from os import (
+    environ,
+    makedirs
+)
+from os.path import (
+    abspath,
+    expanduser,
+    join as path_join
+)
+from select import select
 from subprocess import Popen, TimeoutExpired
-import yaml
+from time import monotonic
+from yaml import dump
 from vtds_base import (
     ContextualError,
     log_paths,
@@ -42,7 +55,63 @@ from vtds_base import (
     write_out
 )
 
-from . import TERRAGRUNT_DIR
+from . import (
+    TERRAGRUNT_DIR,
+    YAMLDumper
+)
+
+# The directory in the build tree where Terraform keeps the provider
+# plugins it downloads, unless 'commands.plugin_cache_dir' names
+# another one. It is outside of the 'terragrunt' tree so that it
+# survives initialize() and the plugins are only downloaded once.
+PLUGIN_CACHE_SUBDIR = "terraform-plugin-cache"
+
+
+class NoAliasDumper(YAMLDumper):  # pylint: disable=too-many-ancestors
+    """YAML dumper that writes out shared data in full every place it
+    appears instead of using anchors and references.
+
+    """
+    def ignore_aliases(self, data):
+        """Never use an alias, no matter what 'data' is.
+
+        """
+        return True
+
+
+@contextmanager
+def exit_fd(process):
+    """Context manager providing a file descriptor that becomes
+    readable when 'process' exits, or None if the platform does not
+    provide one (pidfds need Python 3.9 and Linux 5.3 or later).
+
+    """
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        pidfd = None
+    try:
+        yield pidfd
+    finally:
+        if pidfd is not None:
+            os.close(pidfd)
+
+
+def wait_exit(process, pidfd, timeout):
+    """Wait up to 'timeout' seconds for 'process' to exit and return
+    its exit status, raising TimeoutExpired if it does not exit in
+    time. With a pidfd (see exit_fd()) this sleeps until the
+    process exits or the time runs out instead of polling the way
+    Popen.wait() does when given a timeout.
+
+    """
+    if pidfd is None:
+        return process.wait(timeout=timeout)
+    ready, _, _ = select([pidfd], [], [], timeout)
+    if not ready:
+        raise TimeoutExpired(process.args, timeout)
+    # The process has exited, so this only collects its status.
+    return process.wait()
 
 
 class Terragrunt:
@@ -56,6 +125,12 @@ class Terragrunt:
         """
         self.common = common
         self.tg_cmd = "terragrunt"
+        # The command line for each terragrunt operation, less the
+        # directory to run it in, set up by initialize().
+        self.tg_argv = {}
+        # The environment for terragrunt commands, set up by
+        # initialize().
+        self.tg_env = None
 
     # pylint: disable=unused-argument
     def initialize(self):
@@ -70,18 +145,87 @@ class Terragrunt:
         self.tg_cmd = self.common.get("commands", {}).get(
             'terragrunt', "terragrunt"
         )
+        # Run it by its absolute path (if it is on the PATH) so that
+        # Popen can start it with posix_spawn() instead of fork() and
+        # exec() (see __run()). If it is not found, leave it as it is
+        # and let Popen report the problem.
+        self.tg_cmd = which(self.tg_cmd) or self.tg_cmd
+
+        # The command lines only depend on the configuration, so put
+        # them together once here for all of the operations run by
+        # __run().
+        options = ['--terragrunt-non-interactive']
+        parallelism = self.__parallelism()
+        if parallelism is not None:
+            # Limit both the number of modules Terragrunt works on at
+            # once and the number of resource operations Terraform
+            # runs at once within each.
+            options += [
+                '--terragrunt-parallelism', str(parallelism),
+                '-parallelism=%d' % parallelism,
+            ]
+        self.tg_argv = {
+            operation: [self.tg_cmd, 'run-all', operation, *options]
+            for operation in ('plan', 'apply', 'destroy')
+        }
 
         # Clear out any old terragrunt tree from the build
         # directory. There is potential cached state that can become
         # corrupted and cause spurious failures.
         rmtree(self.build_path("terragrunt"), ignore_errors=True)
 
+        # Provider plugins are only ever added to the plugin cache,
+        # never changed in place, so, unlike the terragrunt tree, it
+        # is safe to keep it from one run to the next.
+        plugin_cache = self.common.get("commands", {}).get(
+            'plugin_cache_dir', None
+        )
+        # Terraform runs in many different directories, so make sure
+        # the path is absolute.
+        plugin_cache = (
+            abspath(expanduser(plugin_cache)) if plugin_cache
+            else self.build_path(PLUGIN_CACHE_SUBDIR)
+        )
+        try:
+            makedirs(plugin_cache, mode=0o755, exist_ok=True)
+        except OSError as err:
+            raise ContextualError(
+                "failed to create terraform plugin cache directory "
+                "'%s' - %s" % (plugin_cache, str(err))
+            ) from err
+        self.tg_env = dict(environ, TF_PLUGIN_CACHE_DIR=plugin_cache)
+
         # Put the initial structure of the terragrunt tree in place in
         # the build directory.
         src = path_join(TERRAGRUNT_DIR, "framework")
         dst = "terragrunt"
         self.add_subtree(src, dst)
 
+    def __parallelism(self):
+        """Class private: Get the configured parallelism for terragrunt
+        operations, making sure it is a positive integer if it is
+        there at all.
+
+        """
+        parallelism = self.common.get("commands", {}).get(
+            'parallelism', None
+        )
+        if parallelism is None:
+            return None
+        try:
+            parallelism = int(parallelism)
+        except (TypeError, ValueError) as err:
+            raise ContextualError(
+                "configuration error: 'commands.parallelism' must be an "
+                "integer, not '%s'" % str(parallelism)
+            ) from err
+        if parallelism < 1:
+            raise ContextualError(
+                "configuration error: 'commands.parallelism' must be "
+                "at least 1, not %d" % parallelism
+            )
+        return parallelism
+
     def __run(self, subdir, operation, tag, timeout=None):
         """Run a terragrunt command in the specified sub-directory of
         the build tree capturing the output in separate output and
@@ -99,40 +243,46 @@ class Terragrunt:
                     "running terragrunt '%s'[%s] in "
                     "'%s' " % (operation, tag, directory)
                 )
+                cmd = [
+                    *self.tg_argv[operation],
+                    '--terragrunt-working-dir', directory
+                ]
+                # Popen only uses posix_spawn(), which does not copy
+                # this (possibly large) process the way fork() does,
+                # when there is no 'cwd' and 'close_fds' is off, so
+                # the directory is passed to terragrunt instead. Files
+                # opened by Python are not inherited anyway.
                 with Popen(
-                    [
-                        self.tg_cmd,
-                        'run-all',
-                        operation,
-                        '--terragrunt-non-interactive'
-                    ],
-                    stdout=out, stderr=err, cwd=directory
-                ) as terragrunt:
-                    time = 0
+                    cmd,
+                    stdout=out, stderr=err, close_fds=False,
+                    env=self.tg_env
+                ) as terragrunt, exit_fd(terragrunt) as pidfd:
+                    deadline = monotonic() + timeout if timeout else None
                     signaled = False
                     while True:
                         try:
-                            exitval = terragrunt.wait(timeout=5)
+                            exitval = wait_exit(terragrunt, pidfd, 5)
+                            # Didn't time out, so the wait is done.
+                            break
                         except TimeoutExpired:
-                            time += 5
-                            if timeout and time > timeout:
-                                if not signaled:
-                                    # First try to terminate the process
-                                    terragrunt.terminate()
-                                    continue
-                                terragrunt.kill()
-                                print()
-                                # pylint: disable=raise-missing-from
-                                raise ContextualError(
-                                    "terragrunt '%s' operation timed out "
-                                    "and did not terminate as expected "
-                                    "after %d seconds" % (operation, time),
-                                    out_path, err_path
-                                )
+                            pass
+                        if deadline is None or monotonic() <= deadline:
                             write_out('.')
                             continue
-                        # Didn't time out, so the wait is done.
-                        break
+                        if not signaled:
+                            # First try to terminate the process and
+                            # give it one more tick to finish.
+                            terragrunt.terminate()
+                            signaled = True
+                            continue
+                        terragrunt.kill()
+                        print()
+                        raise ContextualError(
+                            "terragrunt '%s'[%s] operation timed out and "
+                            "did not terminate as expected after %d "
+                            "seconds" % (operation, tag, timeout),
+                            out_path, err_path
+                        )
                     print()
             except FileNotFoundError as err:
                 raise ContextualError(
@@ -141,12 +291,12 @@ class Terragrunt:
                 ) from err
             if exitval != 0:
                 fmt = (
-                    "terragrunt '%s' operation failed" if not signaled
-                    else "terragrunt '%s' terragrunt operation '%s' "
-                    "timed out and was killed"
+                    "terragrunt '%s'[%s] operation failed" if not signaled
+                    else "terragrunt '%s'[%s] operation timed out and "
+                    "was terminated"
                 )
                 raise ContextualError(
-                    fmt % operation,
+                    fmt % (operation, tag),
                     out_path,
                     err_path
                 )
@@ -298,10 +448,10 @@ class TerragruntConfig:
             with open(config_path, 'w', encoding="UTF-8") as config_file:
                 # Make sure that we get a simple YAML file without
                 # anchors and references.
-                yaml.Dumper.ignore_aliases = lambda *args: True
-                yaml.dump(
+                dump(
                     provider_config,
                     config_file,
+                    Dumper=NoAliasDumper,
                     default_flow_style=False
                 )
         except OSError as err:
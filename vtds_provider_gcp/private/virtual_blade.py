@@ -33,6 +33,11 @@ from vtds_base import (
     render_templated_tree
 )
 
+# Where the virtual blade templates are found in the Terragrunt
+# templates tree, and where they go (under 'terragrunt' and by type
+# name) in the build tree.
+TEMPLATE_SUBPATH = path_join("system", "platform", "virtual-blade")
+
 
 class VirtualBlade:
     """Class representing a single virtual blade type as defined in
@@ -54,14 +59,12 @@ class VirtualBlade:
 
         """
         # Locate the top of the template for blade_interconnects
-        template_dir = self.terragrunt.template_path(
-            path_join("system", "platform", "virtual-blade")
-        )
+        template_dir = self.terragrunt.template_path(TEMPLATE_SUBPATH)
 
         # Copy the templates into the build tree before rendering them.
         build_dir = self.terragrunt.add_subtree(
             template_dir,
-            path_join("terragrunt", "system", "platform", "virtual-blade", key)
+            path_join("terragrunt", TEMPLATE_SUBPATH, key)
         )
 
         # Compose the data to be used in rendering the templated files.